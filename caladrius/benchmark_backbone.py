@@ -0,0 +1,122 @@
+import sys
+import time
+
+import torch
+from torch.nn.modules import loss as nnloss
+from torch.optim import Adam
+
+from utils import configuration, configure_logging, create_logger
+from model.networks.inception_siamese_network import InceptionSiameseNetwork
+from model.networks.light_siamese_network import LightSiameseNetwork
+
+
+logger = create_logger(__name__)
+
+# steps run before timing, to exclude allocation and cudnn autotuning
+WARMUP_STEPS = 3
+BENCHMARK_STEPS = 20
+
+# input size of the transformations of each model type, --input-size is not used by them
+INPUT_SIZES = {"light": 64, "inception": 299}
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def parameter_count(model):
+    # parameters of a shared backbone are only counted once
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+def checkpoint_size(model):
+    # torch.save writes every storage once, so a shared backbone is stored once
+    storages = {}
+    for value in model.state_dict().values():
+        # untyped_storage needs PyTorch 2, as pinned in caladriusenv.yml
+        storage = value.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def pairs_per_second(model, args, training):
+    """
+    Throughput of the model on random before and after images
+    Args:
+        model: Siamese network to benchmark
+        args: configuration of run.py
+        training (bool): time forward, backward and optimizer steps instead of forward passes
+
+    Returns:
+        image pairs per second
+    """
+    device = args.device
+    memory_format = (
+        torch.channels_last if args.channels_last else torch.contiguous_format
+    )
+    input_size = INPUT_SIZES[args.model_type]
+    shape = (args.batch_size, 3, input_size, input_size)
+    image1 = torch.randn(shape, device=device).contiguous(memory_format=memory_format)
+    image2 = torch.randn(shape, device=device).contiguous(memory_format=memory_format)
+    labels = torch.rand(args.batch_size, device=device)
+    criterion = nnloss.MSELoss()
+    optimizer = Adam(model.parameters(), lr=args.learning_rate)
+
+    model.train(training)
+    with torch.set_grad_enabled(training):
+        for step in range(WARMUP_STEPS + BENCHMARK_STEPS):
+            if step == WARMUP_STEPS:
+                synchronize(device)
+                start = time.perf_counter()
+            with torch.autocast(
+                device_type=device.type,
+                dtype=torch.bfloat16,
+                enabled=(args.precision == "bf16"),
+            ):
+                outputs = model(image1, image2).squeeze(1)
+            if training:
+                optimizer.zero_grad()
+                loss = criterion(outputs.float(), labels)
+                loss.backward()
+                optimizer.step()
+        synchronize(device)
+    return BENCHMARK_STEPS * args.batch_size / (time.perf_counter() - start)
+
+
+def main():
+    """
+    Compare two backbones with one shared backbone for the model of --model-type,
+    takes the same arguments as run.py, of which --model-type, --batch-size,
+    --learning-rate, --precision, --channels-last and the device are used
+    """
+    args = configuration()
+    configure_logging(args)
+    logger.info("python {}".format(" ".join(sys.argv)))
+
+    if args.model_type not in INPUT_SIZES:
+        raise ValueError("{} is not a neural model".format(args.model_type))
+    network_architecture_class = InceptionSiameseNetwork
+    if args.model_type == "light":
+        network_architecture_class = LightSiameseNetwork
+
+    for shared_backbone in (False, True):
+        torch.manual_seed(args.torch_seed)
+        model = network_architecture_class(shared_backbone=shared_backbone)
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        model = model.to(args.device)
+        logger.info(
+            "{} backbone: {} parameters, {:.1f} MB checkpoint, "
+            "{:.1f} training pairs/s, {:.1f} inference pairs/s".format(
+                "shared" if shared_backbone else "separate",
+                parameter_count(model),
+                checkpoint_size(model) / 1024 ** 2,
+                pairs_per_second(model, args, training=True),
+                pairs_per_second(model, args, training=False),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+from PIL import Image
+
+from utils import dotdict
+from model.data import Datasets
+from model.networks.inception_siamese_network import get_pretrained_iv3_transforms
+from model.networks.light_siamese_network import get_light_siamese_transforms
+
+logger = logging.getLogger(__name__)
+
+TRANSFORMS = {
+    "inception": get_pretrained_iv3_transforms,
+    "light": get_light_siamese_transforms,
+}
+
+
+def create_synthetic_dataset(data_path, number_of_datapoints, image_size, seed=0):
+    """
+    Write a train set in the layout of a Caladrius dataset, with random images
+    Args:
+        data_path (str): directory to write the train directory to
+        number_of_datapoints (int): number of before and after image pairs
+        image_size (int): width and height of the images in pixels
+        seed (int): seed of the random images and labels
+    """
+    random = np.random.RandomState(seed)
+    set_path = os.path.join(data_path, "train")
+    for directory in ("before", "after"):
+        os.makedirs(os.path.join(set_path, directory), exist_ok=True)
+    with open(os.path.join(set_path, "labels.txt"), "w") as labels_file:
+        for index in range(number_of_datapoints):
+            filename = "{}.png".format(index)
+            for directory in ("before", "after"):
+                pixels = random.randint(0, 256, (image_size, image_size, 3), np.uint8)
+                Image.fromarray(pixels).save(
+                    os.path.join(set_path, directory, filename)
+                )
+            labels_file.write("{} {}\n".format(filename, random.rand()))
+
+
+def samples_per_second(data_path, model_type, number_of_workers, batch_size, batches):
+    """
+    Throughput of the train loader of Datasets.load
+    Args:
+        data_path (str): path of the Caladrius dataset
+        model_type (str): model type of the training transformations
+        number_of_workers (int): number of data loader workers
+        batch_size (int): number of datapoints per batch
+        batches (int): number of batches timed, the dataset is repeated if needed
+
+    Returns:
+        seconds to the first batch, datapoints per second after the first batch
+    """
+    args = dotdict(
+        {
+            "data_path": data_path,
+            "batch_size": batch_size,
+            "number_of_workers": number_of_workers,
+            "max_data_points": None,
+            "packed_data_path": None,
+            "transform_cache_path": None,
+            "input_size": None,
+            "distributed": False,
+            "torch_seed": 0,
+            "sampler": "shuffle",
+            "output_type": "regression",
+        }
+    )
+    transforms = {"train": TRANSFORMS[model_type]("train")}
+    _, loader = Datasets(args, transforms).load("train")
+    if len(loader) == 0:
+        raise ValueError("batch size {} is larger than the dataset".format(batch_size))
+
+    start = time.perf_counter()
+    # the first batch includes starting the workers, it is timed separately
+    epochs = itertools.chain.from_iterable(itertools.repeat(loader))
+    next(iter(epochs))
+    first_batch = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in itertools.islice(epochs, batches):
+        pass
+    return first_batch, batches * batch_size / (time.perf_counter() - start)
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Configurations whose throughput dropped by more than the tolerance
+    Args:
+        results (list): results of this run
+        baseline (list): results of an earlier run, read from its JSON file
+        tolerance (float): allowed relative drop of the datapoints per second
+
+    Returns:
+        list of (configuration, baseline throughput, throughput)
+    """
+    configuration_keys = ("model_type", "number_of_workers", "batch_size", "input_size")
+    baseline_throughput = {
+        tuple(result[key] for key in configuration_keys): result["samples_per_second"]
+        for result in baseline
+    }
+    regressions = []
+    for result in results:
+        configuration = tuple(result[key] for key in configuration_keys)
+        if configuration not in baseline_throughput:
+            continue
+        if result["samples_per_second"] < baseline_throughput[configuration] * (
+            1 - tolerance
+        ):
+            regressions.append(
+                (
+                    dict(zip(configuration_keys, configuration)),
+                    baseline_throughput[configuration],
+                    result["samples_per_second"],
+                )
+            )
+    return regressions
+
+
+def main():
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.DEBUG,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--data-path",
+        type=str,
+        default=None,
+        help="directory for the synthetic datasets, a temporary directory when not set",
+    )
+    parser.add_argument(
+        "--number-of-datapoints",
+        type=int,
+        default=256,
+        help="number of before and after image pairs of the synthetic dataset",
+    )
+    parser.add_argument(
+        "--input-sizes",
+        type=int,
+        nargs="+",
+        default=[64, 128],
+        help="width and height in pixels of the synthetic before and after images",
+    )
+    parser.add_argument(
+        "--model-types",
+        type=str,
+        nargs="+",
+        default=["inception", "light"],
+        choices=sorted(TRANSFORMS),
+        help="model types whose training transformations are benchmarked",
+    )
+    parser.add_argument(
+        "--number-of-workers",
+        type=int,
+        nargs="+",
+        default=[0, 2, 4, 8],
+        help="numbers of data loader workers",
+    )
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[32], help="batch sizes"
+    )
+    parser.add_argument(
+        "--batches",
+        type=int,
+        default=20,
+        help="number of batches timed for every configuration",
+    )
+    parser.add_argument(
+        "--output-path",
+        type=str,
+        default="dataloader_benchmark.json",
+        help="JSON file to write the results to",
+    )
+    parser.add_argument(
+        "--baseline-path",
+        type=str,
+        default=None,
+        help="JSON file of an earlier run, exit with an error if a configuration got slower",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative drop of the datapoints per second compared to the baseline",
+    )
+    args = parser.parse_args()
+
+    logger.info("python {}".format(" ".join(sys.argv)))
+
+    data_path = args.data_path
+    if data_path is None:
+        data_path = tempfile.mkdtemp(prefix="caladrius_benchmark_")
+    results = []
+    try:
+        for input_size in args.input_sizes:
+            input_data_path = os.path.join(
+                data_path, "input_size_{}".format(input_size)
+            )
+            if not os.path.exists(os.path.join(input_data_path, "train", "labels.txt")):
+                create_synthetic_dataset(
+                    input_data_path, args.number_of_datapoints, input_size
+                )
+            for model_type, number_of_workers, batch_size in itertools.product(
+                args.model_types, args.number_of_workers, args.batch_sizes
+            ):
+                first_batch, throughput = samples_per_second(
+                    input_data_path,
+                    model_type,
+                    number_of_workers,
+                    batch_size,
+                    args.batches,
+                )
+                logger.info(
+                    "{} transforms, {} workers, batch size {}, {}px images: "
+                    "{:.1f} datapoints/s, first batch after {:.2f}s".format(
+                        model_type,
+                        number_of_workers,
+                        batch_size,
+                        input_size,
+                        throughput,
+                        first_batch,
+                    )
+                )
+                results.append(
+                    {
+                        "model_type": model_type,
+                        "number_of_workers": number_of_workers,
+                        "batch_size": batch_size,
+                        "input_size": input_size,
+                        "samples_per_second": throughput,
+                        "first_batch_seconds": first_batch,
+                    }
+                )
+    finally:
+        if args.data_path is None:
+            shutil.rmtree(data_path)
+
+    with open(args.output_path, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    logger.info("Results written to {}".format(args.output_path))
+
+    failed = False
+    if args.baseline_path is not None:
+        with open(args.baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        for configuration, baseline_throughput, throughput in find_regressions(
+            results, baseline, args.tolerance
+        ):
+            logger.error(
+                "{}: {:.1f} datapoints/s, was {:.1f}".format(
+                    configuration, throughput, baseline_throughput
+                )
+            )
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# modules that take seconds to import and must only be imported on the paths using them
+HEAVY_MODULES = ["torch", "torchvision", "torch.utils.tensorboard", "sklearn"]
+
+# what is imported, and which heavy modules that may import
+IMPORTS = [
+    ("utils", []),
+    ("model.data", ["torch"]),
+    ("model.predictions", []),
+    ("model.networks.inception_siamese_network", ["torch"]),
+    ("model.trainer", ["torch"]),
+]
+
+IMPORT_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(" ".join(module for module in {heavy_modules!r} if module in sys.modules))
+"""
+
+
+def script_directory():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def time_import(module):
+    """
+    Import a module in a new python process
+    Returns:
+        seconds the import took, heavy modules imported by it
+    """
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            IMPORT_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES),
+        ],
+        cwd=script_directory(),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.splitlines()
+    seconds = float(output[0])
+    heavy_modules = output[1].split() if len(output) > 1 else []
+    return seconds, heavy_modules
+
+
+def time_help():
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(script_directory(), "run.py"), "--help"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.DEBUG,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="number of times each import is timed, the fastest time is reported",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for module, allowed_modules in IMPORTS:
+        timings = [time_import(module) for _ in range(args.repeats)]
+        seconds = min(seconds for seconds, _ in timings)
+        heavy_modules = timings[0][1]
+        logger.info(
+            "import {}: {:.2f}s, imports {}".format(
+                module, seconds, ", ".join(heavy_modules) or "no heavy modules"
+            )
+        )
+        unexpected_modules = set(heavy_modules) - set(allowed_modules)
+        if unexpected_modules:
+            logger.error(
+                "import {} should not import {}".format(
+                    module, ", ".join(sorted(unexpected_modules))
+                )
+            )
+            failed = True
+
+    seconds = min(time_help() for _ in range(args.repeats))
+    logger.info("run.py --help: {:.2f}s".format(seconds))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import os
 import sys
 import argparse
+import hashlib
+import json
+import multiprocessing
 
 from shutil import move
 
 import rasterio
+import rtree.index
 import pandas as pd
 import geopandas
 from geopandas.tools import reverse_geocode
@@ -18,6 +22,8 @@ import rasterio.mask
 import rasterio.features
 import rasterio.warp
 
+from window_crop import BlockCache, crop_geometry
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -48,6 +54,8 @@ ROOT_DIRECTORY = os.path.join("data", "RC Challenge 1", "1")
 BEFORE_FOLDER = os.path.join(ROOT_DIRECTORY, "Before")
 AFTER_FOLDER = os.path.join(ROOT_DIRECTORY, "After")
 
+BEFORE_FILE = os.path.join(BEFORE_FOLDER, "IGN_Feb2017_20CM.tif")
+
 GEOJSON_FOLDER = os.path.join(ROOT_DIRECTORY, "Building Info")
 
 ALL_BUILDINGS_GEOJSON_FILE = os.path.join(GEOJSON_FOLDER, "AllBuildingOutline.geojson")
@@ -64,6 +72,7 @@ TEMP_DATA_FOLDER = os.path.join(TARGET_DATA_FOLDER, "temp")
 os.makedirs(TEMP_DATA_FOLDER, exist_ok=True)
 
 LABELS_FILE = os.path.join(TEMP_DATA_FOLDER, "labels.txt")
+MANIFEST_FILE = os.path.join(TARGET_DATA_FOLDER, "manifest.json")
 ADDRESS_CACHE = os.path.join(TARGET_DATA_FOLDER, "address_cache.esri")
 
 # Administrative boundaries file
@@ -156,8 +165,8 @@ def saveImage(image, transform, out_meta, folder, name):
     return file_path
 
 
-def getBeforeImage(source, geometry, name):
-    image, transform = rasterio.mask.mask(source, geometry, crop=True)
+def getBeforeImage(source, geometry, name, block_cache=None):
+    image, transform = crop_geometry(source, geometry, block_cache)
     out_meta = source.meta.copy()
     good_pixel_frac = np.count_nonzero(image) / image.size
     if np.sum(image) > 0 and good_pixel_frac > NONZERO_PIXEL_THRESHOLD:
@@ -165,27 +174,53 @@ def getBeforeImage(source, geometry, name):
     return None
 
 
-def getAfterImage(geometry, name):
-    after_files = [
+def squareBounds(geometry):
+    coordinates = geometry[0]["coordinates"][0][0]
+    xs = [x for x, _ in coordinates]
+    ys = [y for _, y in coordinates]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def createAfterImageIndex():
+    """
+    Open every after image once and index the tile footprints in an R-tree,
+    so that a building is only masked against the tiles it overlaps.
+    Returns:
+        after_index (rtree.index.Index): tile bounds keyed by position in after_sources
+        after_sources (list): open rasterio datasets, to be closed by the caller
+    """
+    after_files = sorted(
         os.path.join(AFTER_FOLDER, after_file)
         for after_file in os.listdir(AFTER_FOLDER)
         if after_file.endswith(".tif")
-    ]
+    )
+    after_index = rtree.index.Index()
+    after_sources = []
+    for file in after_files:
+        source = rasterio.open(file)
+        after_index.insert(len(after_sources), tuple(source.bounds))
+        after_sources.append(source)
+    logger.info("Indexed {} after images".format(len(after_sources)))
+    return after_index, after_sources
+
+
+def getAfterImage(geometry, name, after_index, after_sources, block_cache=None):
+    candidates = sorted(after_index.intersection(squareBounds(geometry)))
     image_list = []
-    for index, file in enumerate(after_files):
+    for position in candidates:
+        after_file = after_sources[position]
         try:
-            with rasterio.open(file) as after_file:
-                image, transform = rasterio.mask.mask(after_file, geometry, crop=True)
-                good_pixel_frac = np.count_nonzero(image) / image.size
-                if np.sum(image) > 0 and good_pixel_frac > NONZERO_PIXEL_THRESHOLD:
-                    image_list.append(
-                        {
-                            "after_file": after_file,
-                            "good_pixel_frac": good_pixel_frac,
-                            "image": image,
-                            "transform": transform,
-                        }
-                    )
+            image, transform = crop_geometry(after_file, geometry, block_cache)
+            good_pixel_frac = np.count_nonzero(image) / image.size
+            if np.sum(image) > 0 and good_pixel_frac > NONZERO_PIXEL_THRESHOLD:
+                image_list.append(
+                    {
+                        "after_file": after_file,
+                        "good_pixel_frac": good_pixel_frac,
+                        "image": image,
+                        "transform": transform,
+                    }
+                )
         except ValueError:
             pass
     if len(image_list) == 0:
@@ -196,64 +231,295 @@ def getAfterImage(geometry, name):
         after_image = image_list[
             np.argmax(np.array([image["good_pixel_frac"] for image in image_list]))
         ]
-    return saveImage(
+    file_path = saveImage(
         after_image["image"],
         after_image["transform"],
         after_image["after_file"].meta.copy(),
         "after",
         name,
     )
+    return file_path, os.path.basename(after_image["after_file"].name)
 
 
-def createDatapoints(df, label_type):
+# rasterio datasets opened once per process by openExtractor
+EXTRACTOR = {}
+
+
+def openExtractor(block_cache_size=0):
+    EXTRACTOR["before_source"] = rasterio.open(BEFORE_FILE)
+    EXTRACTOR["after_index"], EXTRACTOR["after_sources"] = createAfterImageIndex()
+    EXTRACTOR["block_cache"] = (
+        BlockCache(block_cache_size * 1024 * 1024) if block_cache_size > 0 else None
+    )
+
+
+def closeExtractor():
+    EXTRACTOR.pop("before_source").close()
+    EXTRACTOR.pop("after_index")
+    EXTRACTOR.pop("block_cache")
+    for after_source in EXTRACTOR.pop("after_sources"):
+        after_source.close()
+
+
+def extractDatapoint(datapoint):
+    """
+    Create the before and after image stamps of a single building
+    Args:
+        datapoint (tuple): OBJECTID and bounds of the building shape
+
+    Returns:
+        checksums of the image stamps and the after image used, None if not both were saved
+    """
+    objectID, bounds = datapoint
+    geoms = makesquare(*bounds)
+    name = "{}.png".format(objectID)
+    try:
+        before_file = getBeforeImage(
+            EXTRACTOR["before_source"], geoms, name, EXTRACTOR["block_cache"]
+        )
+        after = getAfterImage(
+            geoms,
+            name,
+            EXTRACTOR["after_index"],
+            EXTRACTOR["after_sources"],
+            EXTRACTOR["block_cache"],
+        )
+    except ValueError:
+        return None
+    if (
+        (before_file is not None)
+        and os.path.isfile(before_file)
+        and (after is not None)
+        and os.path.isfile(after[0])
+    ):
+        return {
+            "tile": after[1],
+            "before": fileChecksum(before_file),
+            "after": fileChecksum(after[0]),
+        }
+    return None
+
+
+def extractDatapoints(datapoints, workers, block_cache_size=0):
+    """
+    Yields the result of extractDatapoint for every datapoint, in order.
+    With more than one worker the datapoints are sharded over a process pool
+    in which every process keeps its own open rasterio datasets.
+    """
+    if workers > 1:
+        chunksize = max(1, len(datapoints) // (workers * 4))
+        with multiprocessing.Pool(
+            workers, initializer=openExtractor, initargs=(block_cache_size,)
+        ) as pool:
+            yield from pool.imap(extractDatapoint, datapoints, chunksize=chunksize)
+    else:
+        openExtractor(block_cache_size)
+        try:
+            yield from map(extractDatapoint, datapoints)
+        finally:
+            closeExtractor()
+
+
+# The manifest records, per OBJECTID, the hash of the building bounds, the after
+# image used, the checksums of the image stamps, the label and the assigned split.
+# It is saved atomically while the dataset is created, so reruns skip unchanged
+# buildings and interrupted runs continue where they stopped.
+
+
+def loadManifest():
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE) as manifest_file:
+            return json.load(manifest_file)
+    return {"label_type": None, "datapoints": {}}
+
+
+def saveManifest(manifest):
+    temporary_manifest_file = MANIFEST_FILE + ".tmp"
+    with open(temporary_manifest_file, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_manifest_file, MANIFEST_FILE)
+
+
+def hashBounds(bounds):
+    return hashlib.sha1(repr(tuple(bounds)).encode()).hexdigest()
+
+
+def fileChecksum(file_path):
+    with open(file_path, "rb") as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def splitFolder(split):
+    return (
+        TEMP_DATA_FOLDER if split is None else os.path.join(TARGET_DATA_FOLDER, split)
+    )
+
+
+def findImageStamps(name, split, checksums=None):
+    """
+    Returns the before and after image stamp paths of a datapoint,
+    None if they are missing or do not match the checksums.
+    """
+    for folder in {splitFolder(split), TEMP_DATA_FOLDER}:
+        paths = [os.path.join(folder, moment, name) for moment in ("before", "after")]
+        if all(os.path.isfile(path) for path in paths):
+            if checksums is None or [fileChecksum(path) for path in paths] == checksums:
+                return paths
+    return None
 
-    logger.info("Feature Size {}".format(len(df)))
 
-    BEFORE_FILE = os.path.join(BEFORE_FOLDER, "IGN_Feb2017_20CM.tif")
+def moveImageStamps(name, split):
+    for moment in ("before", "after"):
+        source = os.path.join(TEMP_DATA_FOLDER, moment, name)
+        if os.path.isfile(source):
+            directory = os.path.join(splitFolder(split), moment)
+            os.makedirs(directory, exist_ok=True)
+            move(source, os.path.join(directory, name))
 
-    with open(LABELS_FILE, "w+") as labels_file:
-        with rasterio.open(BEFORE_FILE) as source_before_image:
 
-            count = 0
+def removeImageStamps(name, split):
+    for folder in {splitFolder(split), TEMP_DATA_FOLDER}:
+        for moment in ("before", "after"):
+            path = os.path.join(folder, moment, name)
+            if os.path.isfile(path):
+                os.remove(path)
 
-            for index, row in tqdm(df.iterrows(), total=df.shape[0]):
 
-                damage = row["_damage"]
+def writeLabelsFile(filepath, lines):
+    temporary_filepath = filepath + ".tmp"
+    with open(temporary_filepath, "w+") as labels_file:
+        labels_file.writelines(lines)
+    os.replace(temporary_filepath, filepath)
 
-                bounds = row["geometry"].bounds
-                geoms = makesquare(*bounds)
 
-                # identify data point
-                objectID = row["OBJECTID"]
+def createDatapoints(
+    df,
+    label_type,
+    workers=1,
+    block_cache_size=0,
+    verify_image_stamps=False,
+    manifest_save_step=1000,
+):
 
-                try:
-                    before_file = getBeforeImage(
-                        source_before_image, geoms, "{}.png".format(objectID)
-                    )
-                    after_file = getAfterImage(geoms, "{}.png".format(objectID))
-                    if (
-                        (before_file is not None)
-                        and os.path.isfile(before_file)
-                        and (after_file is not None)
-                        and os.path.isfile(after_file)
-                        and damage in DAMAGE_TYPES
-                    ):
-                        labels_file.write(
-                            "{0}.png {1:.4f}\n".format(
-                                objectID, damage_quantifier(damage, label_type)
-                            )
-                        )
-                        count += 1
-                except ValueError:
-                    continue
+    logger.info("Feature Size {}".format(len(df)))
+
+    manifest = loadManifest()
+    manifest_datapoints = manifest["datapoints"]
+    relabel = manifest["label_type"] != label_type
+    manifest["label_type"] = label_type
+
+    # finish moving image stamps of an interrupted split
+    for key, entry in manifest_datapoints.items():
+        if entry["split"] is not None:
+            moveImageStamps("{}.png".format(key), entry["split"])
+
+    # forget buildings that are no longer in the source file
+    keys = set(str(objectID) for objectID in df["OBJECTID"])
+    for key in [key for key in manifest_datapoints if key not in keys]:
+        removeImageStamps("{}.png".format(key), manifest_datapoints[key]["split"])
+        del manifest_datapoints[key]
+
+    datapoints = []
+    bounds_hashes = []
+    damages = []
+    for objectID, geometry, damage in zip(
+        df["OBJECTID"], df["geometry"], df["_damage"]
+    ):
+        key = str(objectID)
+        name = "{}.png".format(objectID)
+        # missing damage values are stored as null in the manifest
+        damage = damage if isinstance(damage, str) else None
+        bounds_hash = hashBounds(geometry.bounds)
+        entry = manifest_datapoints.get(key)
+        if (
+            entry is not None
+            and entry["bounds"] == bounds_hash
+            and entry["damage"] == damage
+            and (
+                entry["before"] is None
+                or findImageStamps(
+                    name,
+                    entry["split"],
+                    [entry["before"], entry["after"]] if verify_image_stamps else None,
+                )
+                is not None
+            )
+        ):
+            if relabel and entry["label"] is not None:
+                entry["label"] = "{:.4f}".format(damage_quantifier(damage, label_type))
+            continue
+        if entry is not None:
+            removeImageStamps(name, entry["split"])
+        datapoints.append((objectID, geometry.bounds))
+        bounds_hashes.append(bounds_hash)
+        damages.append(damage)
+
+    logger.info(
+        "Skipping {} unchanged datapoints, creating {} datapoints".format(
+            len(df) - len(datapoints), len(datapoints)
+        )
+    )
 
-    logger.info("Created {} Datapoints".format(count))
+    for index, ((objectID, _), bounds_hash, damage, stamps) in enumerate(
+        zip(
+            datapoints,
+            bounds_hashes,
+            damages,
+            tqdm(
+                extractDatapoints(datapoints, workers, block_cache_size),
+                total=len(datapoints),
+            ),
+        ),
+        1,
+    ):
+        key = str(objectID)
+        previous_split = manifest_datapoints.get(key, {}).get("split")
+        entry = {
+            "bounds": bounds_hash,
+            "damage": damage,
+            "tile": None,
+            "before": None,
+            "after": None,
+            "label": None,
+            "split": None,
+        }
+        if stamps is not None:
+            entry.update(stamps)
+            # labels are computed by this process in dataframe order,
+            # so they do not depend on the number of workers
+            if damage in DAMAGE_TYPES:
+                entry["label"] = "{:.4f}".format(damage_quantifier(damage, label_type))
+                if previous_split in ("train", "validation", "test"):
+                    entry["split"] = previous_split
+        manifest_datapoints[key] = entry
+        if index % manifest_save_step == 0:
+            saveManifest(manifest)
+
+    saveManifest(manifest)
+
+    labels = [
+        "{0}.png {1}\n".format(objectID, manifest_datapoints[str(objectID)]["label"])
+        for objectID in df["OBJECTID"]
+        if manifest_datapoints[str(objectID)]["label"] is not None
+    ]
+    writeLabelsFile(LABELS_FILE, labels)
 
+    logger.info("Created {} Datapoints".format(len(labels)))
 
-def splitDatapoints(filepath):
+    return manifest
 
-    with open(filepath) as file:
-        datapoints = file.readlines()
+
+def splitDatapoints(manifest):
+
+    manifest_datapoints = manifest["datapoints"]
+
+    # datapoints that were split before keep their split
+    datapoints = [
+        key
+        for key, entry in manifest_datapoints.items()
+        if entry["label"] is not None
+        and entry["split"] not in ("train", "validation", "test")
+    ]
 
     allIndexes = list(range(len(datapoints)))
 
@@ -269,11 +535,24 @@ def splitDatapoints(filepath):
 
     testing_indexes = allIndexes[validation_offset:]
 
-    split_mappings = {
-        "train": [datapoints[i] for i in training_indexes],
-        "validation": [datapoints[i] for i in validation_indexes],
-        "test": [datapoints[i] for i in testing_indexes],
-    }
+    for split, indexes in (
+        ("train", training_indexes),
+        ("validation", validation_indexes),
+        ("test", testing_indexes),
+    ):
+        for i in indexes:
+            manifest_datapoints[datapoints[i]]["split"] = split
+
+    # record the split before moving any file, so an interrupted split can be finished
+    saveManifest(manifest)
+
+    split_mappings = {"train": [], "validation": [], "test": []}
+
+    for key, entry in manifest_datapoints.items():
+        if entry["split"] in split_mappings:
+            split_mappings[entry["split"]].append(
+                "{0}.png {1}\n".format(key, entry["label"])
+            )
 
     for split in split_mappings:
 
@@ -288,39 +567,28 @@ def splitDatapoints(filepath):
         split_after_directory = os.path.join(split_filepath, "after")
         os.makedirs(split_after_directory, exist_ok=True)
 
-        with open(split_labels_file, "w+") as split_file:
-            for datapoint in tqdm(split_mappings[split]):
-                datapoint_name = datapoint.split(" ")[0]
-
-                before_src = os.path.join(TEMP_DATA_FOLDER, "before", datapoint_name)
-                after_src = os.path.join(TEMP_DATA_FOLDER, "after", datapoint_name)
+        for datapoint in tqdm(split_mappings[split]):
+            datapoint_name = datapoint.split(" ")[0]
+            moveImageStamps(datapoint_name, split)
 
-                before_dst = os.path.join(split_before_directory, datapoint_name)
-                after_dst = os.path.join(split_after_directory, datapoint_name)
-
-                # print('{} => {} !! {}'.format(before_src, before_dst, os.path.isfile(before_src)))
-                move(before_src, before_dst)
-
-                # print('{} => {} !! {}'.format(after_src, after_dst, os.path.isfile(after_src)))
-                move(after_src, after_dst)
-
-                split_file.write(datapoint)
+        writeLabelsFile(split_labels_file, split_mappings[split])
 
     return split_mappings
 
 
-def createInferenceDataset():
-    temp_before_directory = os.path.join(TEMP_DATA_FOLDER, "before")
-    temp_after_directory = os.path.join(TEMP_DATA_FOLDER, "after")
-    images_in_before_directory = [
-        x for x in os.listdir(temp_before_directory) if x.endswith(".png")
-    ]
-    images_in_after_directory = [
-        x for x in os.listdir(temp_after_directory) if x.endswith(".png")
+def createInferenceDataset(manifest):
+    manifest_datapoints = manifest["datapoints"]
+
+    # image stamps of buildings without a label
+    intersection = [
+        key
+        for key, entry in manifest_datapoints.items()
+        if entry["before"] is not None and entry["label"] is None
     ]
-    intersection = list(
-        set(images_in_before_directory) & set(images_in_after_directory)
-    )
+    for key in intersection:
+        manifest_datapoints[key]["split"] = "inference"
+
+    saveManifest(manifest)
 
     inference_directory = os.path.join(TARGET_DATA_FOLDER, "inference")
     os.makedirs(inference_directory, exist_ok=True)
@@ -331,15 +599,8 @@ def createInferenceDataset():
     inference_after_directory = os.path.join(inference_directory, "after")
     os.makedirs(inference_after_directory, exist_ok=True)
 
-    for datapoint_name in intersection:
-        before_image_src = os.path.join(temp_before_directory, datapoint_name)
-        after_image_src = os.path.join(temp_after_directory, datapoint_name)
-
-        before_image_dst = os.path.join(inference_before_directory, datapoint_name)
-        after_image_dst = os.path.join(inference_after_directory, datapoint_name)
-
-        move(before_image_src, before_image_dst)
-        move(after_image_src, after_image_dst)
+    for key in intersection:
+        moveImageStamps("{}.png".format(key), "inference")
 
 
 def query_address_api(df, address_api="openmapquest", address_api_key=None):
@@ -492,6 +753,26 @@ def main():
         metavar="label_type",
         help="Sets whether the damage label should be produced on a continuous scale or in classes.",
     )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes used to create the image stamps",
+    )
+    parser.add_argument(
+        "--verify-image-stamps",
+        action="store_true",
+        default=False,
+        help="Compare the checksums of existing image stamps to the manifest "
+        "and recreate the ones that changed, instead of only checking they exist",
+    )
+    parser.add_argument(
+        "--block-cache-size",
+        default=128,
+        type=int,
+        help="Megabytes of decoded image blocks cached per process and shared "
+        "between neighbouring buildings, 0 reads every image stamp directly",
+    )
 
     args = parser.parse_args()
 
@@ -513,9 +794,15 @@ def main():
 
     if args.create_image_stamps:
         logger.info("Creating training dataset.")
-        createDatapoints(df, args.label_type)
-        splitDatapoints(LABELS_FILE)
-        createInferenceDataset()
+        manifest = createDatapoints(
+            df,
+            args.label_type,
+            workers=args.workers,
+            block_cache_size=args.block_cache_size,
+            verify_image_stamps=args.verify_image_stamps,
+        )
+        splitDatapoints(manifest)
+        createInferenceDataset(manifest)
     else:
         logger.info("Skipping creation of training dataset.")
 
@@ -9,6 +9,7 @@ import rasterio
 import pandas as pd
 import geopandas
 from geopandas.tools import reverse_geocode
+from shapely.geometry import box, shape
 
 import numpy as np
 
@@ -19,6 +20,8 @@ import rasterio.mask
 import rasterio.features
 import rasterio.warp
 
+from window_crop import BlockCache, crop_geometry
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -169,9 +172,9 @@ def get_image_path(geo_image_path, object_id):
     return image_path
 
 
-def match_geometry(image_path, geo_image_file, geometry):
+def match_geometry(image_path, geo_image_file, geometry, block_cache=None):
     try:
-        image, transform = rasterio.mask.mask(geo_image_file, geometry, crop=True)
+        image, transform = crop_geometry(geo_image_file, geometry, block_cache)
         out_meta = geo_image_file.meta.copy()
         good_pixel_fraction = np.count_nonzero(image) / image.size
         if (
@@ -185,7 +188,39 @@ def match_geometry(image_path, geo_image_file, geometry):
         return False
 
 
-def create_datapoints(df):
+def get_image_footprints(image_list, crs):
+    footprints = []
+    for geo_image_path in image_list:
+        with rasterio.open(geo_image_path) as geo_image_file:
+            footprints.append(box(*geo_image_file.bounds))
+    return geopandas.GeoDataFrame(geometry=footprints, crs=crs)
+
+
+def bucket_buildings_by_image(geometries, image_list, crs):
+    """
+    Spatially join the building squares against the footprints of the images
+    Args:
+        geometries (list): square geometry of every building, as made by makesquare
+        image_list (list): paths of the geo images
+        crs: coordinate reference system shared by the buildings and the images
+
+    Returns:
+        buckets (list of lists): for every image, the positions of the buildings it overlaps, in ascending order
+    """
+    squares = geopandas.GeoDataFrame(
+        geometry=[shape(geometry[0]) for geometry in geometries], crs=crs
+    )
+    footprints = get_image_footprints(image_list, crs)
+    overlaps = geopandas.sjoin(squares, footprints, how="inner")
+    buckets = [[] for _ in image_list]
+    for building_position, image_position in sorted(
+        zip(overlaps.index, overlaps["index_right"])
+    ):
+        buckets[image_position].append(building_position)
+    return buckets
+
+
+def create_datapoints(df, block_cache_size=0):
     start_time = datetime.datetime.now()
 
     logger.info("Feature Size {}".format(len(df)))
@@ -196,24 +231,43 @@ def create_datapoints(df):
 
     # logger.info(len(image_list)) # 319
 
+    object_ids = df["OBJECTID"].tolist()
+    damages = df["_damage"].tolist()
+    geometries = [makesquare(*geometry.bounds) for geometry in df["geometry"]]
+
+    buckets = bucket_buildings_by_image(geometries, image_list, df.crs)
+
+    block_cache = (
+        BlockCache(block_cache_size * 1024 * 1024) if block_cache_size > 0 else None
+    )
+
+    logger.info(
+        "Matched {} buildings to {} images in {}".format(
+            len(df), len(image_list), datetime.datetime.now() - start_time
+        )
+    )
+
     with open(LABELS_FILE, "w+") as labels_file:
-        for geo_image_path in tqdm(image_list):
+        for image_number, (geo_image_path, bucket) in enumerate(
+            zip(image_list, buckets), 1
+        ):
+            image_start_time = datetime.datetime.now()
+            image_count = 0
             with rasterio.open(geo_image_path) as geo_image_file:
-                for index, row in tqdm(df.iterrows(), total=df.shape[0]):
+                for building_position in bucket:
 
-                    damage = row["_damage"]
+                    damage = damages[building_position]
 
-                    bounds = row["geometry"].bounds
-                    geometry = makesquare(*bounds)
+                    geometry = geometries[building_position]
 
                     # identify data point
-                    object_id = row["OBJECTID"]
+                    object_id = object_ids[building_position]
 
                     image_path = get_image_path(geo_image_path, object_id)
 
                     if not os.path.exists(image_path):
                         save_success = match_geometry(
-                            image_path, geo_image_file, geometry
+                            image_path, geo_image_file, geometry, block_cache
                         )
                         if save_success:
                             logger.info("Saved image at {}".format(image_path))
@@ -234,6 +288,18 @@ def create_datapoints(df):
                                     )
                                 )
                                 count = count + 1
+                                image_count = image_count + 1
+
+            logger.info(
+                "Image {}/{} {}: {} buildings, {} datapoints in {}".format(
+                    image_number,
+                    len(image_list),
+                    geo_image_path,
+                    len(bucket),
+                    image_count,
+                    datetime.datetime.now() - image_start_time,
+                )
+            )
 
     delta = datetime.datetime.now() - start_time
 
@@ -473,6 +539,13 @@ def main():
         "shapes of the buildings, their respective administrative "
         "regions and addresses (if --query-address-api has been run)",
     )
+    parser.add_argument(
+        "--block-cache-size",
+        default=128,
+        type=int,
+        help="Megabytes of decoded image blocks cached and shared between "
+        "neighbouring buildings, 0 reads every image stamp directly",
+    )
     args = parser.parse_args()
 
     logger.info("Reading source file: {}".format(GEOJSON_FILE))
@@ -495,7 +568,7 @@ def main():
 
     if args.create_image_stamps:
         logger.info("Creating training dataset.")
-        create_datapoints(df)
+        create_datapoints(df, block_cache_size=args.block_cache_size)
         split_datapoints(LABELS_FILE)
         create_inference_dataset()
     else:
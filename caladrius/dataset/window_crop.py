@@ -0,0 +1,131 @@
+from collections import OrderedDict
+
+import numpy as np
+
+import rasterio.mask
+from rasterio.windows import Window
+
+
+class BlockCache(object):
+    """
+    Least recently used cache of decoded raster blocks, so that neighbouring
+    buildings cropped from the same image share the block reads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.blocks = OrderedDict()
+
+    def cacheable(self, dataset):
+        block_height, block_width = dataset.block_shapes[0]
+        block_bytes = (
+            dataset.count
+            * block_height
+            * block_width
+            * (np.dtype(dataset.dtypes[0]).itemsize + 1)
+        )
+        # huge blocks (e.g. untiled single strip images) are read directly
+        return block_bytes * 4 <= self.max_bytes
+
+    def get_block(self, dataset, block_row, block_col):
+        key = (dataset.name, block_row, block_col)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        block_height, block_width = dataset.block_shapes[0]
+        row_off = block_row * block_height
+        col_off = block_col * block_width
+        window = Window(
+            col_off=col_off,
+            row_off=row_off,
+            width=min(block_width, dataset.width - col_off),
+            height=min(block_height, dataset.height - row_off),
+        )
+        block = dataset.read(window=window, masked=True)
+        block = (block.data, np.ma.getmaskarray(block))
+
+        self.blocks[key] = block
+        self.bytes += block[0].nbytes + block[1].nbytes
+        while self.bytes > self.max_bytes and len(self.blocks) > 1:
+            _, (data, mask) = self.blocks.popitem(last=False)
+            self.bytes -= data.nbytes + mask.nbytes
+        return block
+
+    def read(self, dataset, window):
+        """
+        Same as dataset.read(window=window, masked=True), for a window inside the raster
+        """
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_stop = row_start + int(window.height)
+        col_stop = col_start + int(window.width)
+        height, width = dataset.block_shapes[0]
+
+        data = np.empty(
+            (dataset.count, row_stop - row_start, col_stop - col_start),
+            dtype=dataset.dtypes[0],
+        )
+        mask = np.empty(data.shape, dtype=bool)
+
+        for block_row in range(row_start // height, (row_stop - 1) // height + 1):
+            for block_col in range(col_start // width, (col_stop - 1) // width + 1):
+                block_data, block_mask = self.get_block(dataset, block_row, block_col)
+                row_off = block_row * height
+                col_off = block_col * width
+                # overlap between the block and the window, in raster pixels
+                top = max(row_start, row_off)
+                bottom = min(row_stop, row_off + block_data.shape[1])
+                left = max(col_start, col_off)
+                right = min(col_stop, col_off + block_data.shape[2])
+                target = (
+                    slice(None),
+                    slice(top - row_start, bottom - row_start),
+                    slice(left - col_start, right - col_start),
+                )
+                source = (
+                    slice(None),
+                    slice(top - row_off, bottom - row_off),
+                    slice(left - col_off, right - col_off),
+                )
+                data[target] = block_data[source]
+                mask[target] = block_mask[source]
+
+        return np.ma.masked_array(data, mask)
+
+
+def crop_geometry(dataset, geometry, block_cache=None):
+    """
+    Crop an image stamp out of a raster with a windowed read
+    Gives the same output as rasterio.mask.mask(dataset, geometry, crop=True):
+    the window and the mask of the pixels outside the geometry are computed the same way,
+    only the pixel read goes through the block cache when one is given.
+    Args:
+        dataset: open rasterio dataset
+        geometry (list of dicts): shapes to crop, as made by makesquare
+        block_cache (BlockCache): optional cache of decoded raster blocks
+
+    Returns:
+        image (np.ndarray): bands x height x width pixels, outside the geometry set to nodata
+        transform: transformation of the cropped image
+    """
+    shape_mask, transform, window = rasterio.mask.raster_geometry_mask(
+        dataset, geometry, crop=True
+    )
+
+    if (
+        block_cache is None
+        or int(window.width) == 0
+        or int(window.height) == 0
+        or not block_cache.cacheable(dataset)
+    ):
+        image = dataset.read(
+            window=window, out_shape=(dataset.count,) + shape_mask.shape, masked=True
+        )
+    else:
+        image = block_cache.read(dataset, window)
+
+    image.mask = image.mask | shape_mask
+
+    nodata = dataset.nodata if dataset.nodata is not None else 0
+    return image.filled(nodata), transform
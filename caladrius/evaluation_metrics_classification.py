@@ -12,6 +12,8 @@ from sklearn.metrics import confusion_matrix
 from sklearn.metrics import classification_report
 import matplotlib.pyplot as plt
 
+from model.predictions import load_predictions
+
 
 def plot_confusionmatrix(y_true, y_pred, filename, labels, figsize=(10, 10)):
     """
@@ -69,18 +71,20 @@ def gen_score_overview(preds_filename):
     """
     Generate a dataframe with several performance measures
     Args:
-        preds_filename: name of file where predictions are saved
+        preds_filename: text file or directory of .npy columns where predictions are saved
 
     Returns:
         score_overview (pd.DataFrame): dataframe with several performance measures
         df_pred (pd.DataFrame): dataframe with the predictions and true labels
     """
-    preds_file = open(preds_filename)
-    lines = preds_file.readlines()[1:]
-    pred_info = []
-    for l in lines:
-        pred_info.extend([l.rstrip().split(" ")])
-    df_pred = pd.DataFrame(pred_info, columns=["OBJECTID", "label", "pred"])
+    predictions = load_predictions(preds_filename)
+    df_pred = pd.DataFrame(
+        {
+            "OBJECTID": predictions["filename"],
+            "label": predictions["label"],
+            "pred": predictions["prediction"],
+        }
+    )
     df_pred.label = df_pred.label.astype(int)
     df_pred.pred = df_pred.pred.astype(int)
 
@@ -257,14 +261,15 @@ def main():
         )
 
     # define all file names and paths
-    test_file_name = "{}-split_test-epoch_001-model_siamese-predictions.txt".format(
+    # predictions written with --prediction-format npy are directories without extension
+    test_file_name = "{}-split_test-epoch_001-model_siamese-predictions".format(
         args.run_name
     )
     preds_model = "{}/predictions/{}".format(args.run_folder, test_file_name)
-    preds_random = "{}-split_test-epoch_001-model_random-predictions.txt".format(
+    preds_random = "{}-split_test-epoch_001-model_random-predictions".format(
         args.run_name
     )
-    preds_average = "{}-split_test-epoch_001-model_average-predictions.txt".format(
+    preds_average = "{}-split_test-epoch_001-model_average-predictions".format(
         args.run_name
     )
     output_path = "./performance/"
@@ -278,6 +283,8 @@ def main():
     for preds_filename, preds_type in zip(
         [preds_model, preds_random, preds_average], ["model", "random", "average"]
     ):
+        if os.path.exists(preds_filename + ".txt"):
+            preds_filename = preds_filename + ".txt"
         # check if file for preds type exists
         if os.path.exists(preds_filename):
             # generate overview with performance measures
@@ -1,6 +1,9 @@
 import os
 import sys
 import argparse
+import multiprocessing
+from collections import OrderedDict
+from functools import partial
 
 import json
 import numpy as np
@@ -20,6 +23,8 @@ from shutil import move,rmtree
 import shapely.wkt
 import logging
 
+from dataset.window_crop import BlockCache, crop_geometry
+
 logger = logging.getLogger(__name__)
 logging.getLogger("fiona").setLevel(logging.ERROR)
 logging.getLogger("fiona.collection").setLevel(logging.ERROR)
@@ -132,12 +137,14 @@ def saveImage(image, transform, out_meta, folder, name,path_temp_data):
     Returns:
         file_path (str): path where image is saved
     """
-    out_meta.update({
+    out_meta.update(
+        {
             "driver": "PNG",
             "height": image.shape[1],
             "width": image.shape[2],
-            "transform": transform
-        })
+            "transform": transform,
+        }
+    )
     directory = os.path.join(path_temp_data, folder)
     os.makedirs(directory, exist_ok=True)
     file_path = os.path.join(directory, name)
@@ -145,6 +152,47 @@ def saveImage(image, transform, out_meta, folder, name,path_temp_data):
         dest.write(image)
     return file_path
 
+
+# rasterio datasets kept open per process, most recently used last
+OPEN_IMAGES = OrderedDict()
+MAX_OPEN_IMAGES = 16
+
+# decoded image blocks cached per process, set by setBlockCache
+BLOCK_CACHE = None
+
+
+def setBlockCache(block_cache_size):
+    """
+    Args:
+        block_cache_size (int): megabytes of decoded image blocks to cache, 0 disables the cache
+    """
+    global BLOCK_CACHE
+    BLOCK_CACHE = (
+        BlockCache(block_cache_size * 1024 * 1024) if block_cache_size > 0 else None
+    )
+
+
+def openImage(source_image):
+    """
+    Returns an open rasterio dataset for source_image, reusing the handle if the image was opened before.
+    Consecutive buildings mostly come from the same image, so only a few handles are kept open.
+    Args:
+        source_image (str): path where image is saved
+    """
+    if source_image in OPEN_IMAGES:
+        OPEN_IMAGES.move_to_end(source_image)
+    else:
+        OPEN_IMAGES[source_image] = rasterio.open(source_image)
+        if len(OPEN_IMAGES) > MAX_OPEN_IMAGES:
+            OPEN_IMAGES.popitem(last=False)[1].close()
+    return OPEN_IMAGES[source_image]
+
+
+def closeImages():
+    while OPEN_IMAGES:
+        OPEN_IMAGES.popitem()[1].close()
+
+
 def getImage(source_image, geometry, moment, name, path_temp_data,nonzero_pixel_threshold=0.90):
     """
     Retrieves an image and calls the function saveImage() to save the image
@@ -155,13 +203,13 @@ def getImage(source_image, geometry, moment, name, path_temp_data,nonzero_pixel_
         name (str): name with which the image with the cropped building should be saved
         nonzero_pixel_threshold (float): Fraction of image pixels that must be non-zero
     """
-    with rasterio.open(source_image) as source:
-        image, transform = rasterio.mask.mask(source, geometry, crop=True)
-        out_meta = source.meta.copy()
-        good_pixel_frac = np.count_nonzero(image) / image.size
-        if np.sum(image) > 0 and good_pixel_frac > nonzero_pixel_threshold:
-            return saveImage(image, transform, out_meta, moment, name,path_temp_data)
-        return None
+    source = openImage(source_image)
+    image, transform = crop_geometry(source, geometry, BLOCK_CACHE)
+    out_meta = source.meta.copy()
+    good_pixel_frac = np.count_nonzero(image) / image.size
+    if np.sum(image) > 0 and good_pixel_frac > nonzero_pixel_threshold:
+        return saveImage(image, transform, out_meta, moment, name, path_temp_data)
+    return None
 
 def splitDatapoints(filepath_labels,path_output,path_temp_data,train_split=0.8,validation_split=0.1,test_split=0.1):
     """
@@ -232,7 +280,75 @@ def splitDatapoints(filepath_labels,path_output,path_temp_data,train_split=0.8,v
 
     return split_mappings
 
-def createDatapoints(df,path_images_before,path_images_after, path_temp_data,label_type,list_damage_types):
+
+def extractDatapoint(datapoint, path_temp_data):
+    """
+    Creates the before and after image of a single building.
+    Args:
+        datapoint (tuple): OBJECTID, before image path, before bounds, after image path and after bounds of the building
+        path_temp_data (str): path where the images are saved
+
+    Returns (bool): True if both images were saved
+    """
+    objectID, image_pre, bounds_pre, image_post, bounds_post = datapoint
+    try:
+        # call function to crop the image to the building, which in turn calls function to save the cropped image
+        before_file = getImage(
+            image_pre,
+            makesquare(*bounds_pre),
+            "before",
+            "{}.png".format(objectID),
+            path_temp_data,
+        )
+        after_file = getImage(
+            image_post,
+            makesquare(*bounds_post),
+            "after",
+            "{}.png".format(objectID),
+            path_temp_data,
+        )
+    except ValueError:
+        return False
+    return (
+        (before_file is not None)
+        and os.path.isfile(before_file)
+        and (after_file is not None)
+        and os.path.isfile(after_file)
+    )
+
+
+def extractDatapoints(datapoints, path_temp_data, workers=1, block_cache_size=0):
+    """
+    Yields the result of extractDatapoint for every datapoint, in order.
+    With more than one worker the datapoints are sharded in contiguous chunks over a process pool,
+    every process keeps its own open rasterio datasets.
+    """
+    extract = partial(extractDatapoint, path_temp_data=path_temp_data)
+    if workers > 1:
+        chunksize = max(1, len(datapoints) // (workers * 4))
+        with multiprocessing.Pool(
+            workers, initializer=setBlockCache, initargs=(block_cache_size,)
+        ) as pool:
+            yield from pool.imap(extract, datapoints, chunksize=chunksize)
+    else:
+        setBlockCache(block_cache_size)
+        try:
+            yield from map(extract, datapoints)
+        finally:
+            closeImages()
+            setBlockCache(0)
+
+
+def createDatapoints(
+    df,
+    path_images_before,
+    path_images_after,
+    path_temp_data,
+    label_type,
+    list_damage_types,
+    workers=1,
+    block_cache_size=0,
+):
     """
     Loops through all the building polygons and calls functions which create an image per polygon.
     Args:
@@ -241,46 +357,55 @@ def createDatapoints(df,path_images_before,path_images_after, path_temp_data,lab
         path_images_before (str): path where before images are saved
         path_images_after (str): path where after images are saved
         list_damage_types (list): accepted damage types of buildings
+        workers (int): number of processes used to create the images
+        block_cache_size (int): megabytes of decoded image blocks cached per process
     """
 
     #total number of buildings pre+post
     logger.info('Feature Size {}'.format(len(df)))
 
-    before_files = [os.path.join(path_images_before, before_file) for before_file in os.listdir(path_images_before)]
-    before_files.sort()
+    # filter based on damage. Only accept described damage types. Un-classified is filtered out
+    df = df[df["_damage"].isin(list_damage_types)]
+
+    # .bounds gives the bounding box around the polygon defined in geometry_pre and geometry_post
+    datapoints = [
+        (
+            objectID,
+            os.path.join(path_images_before, file_pre),
+            geometry_pre.bounds,
+            os.path.join(path_images_after, file_post),
+            geometry_post.bounds,
+        )
+        for objectID, file_pre, geometry_pre, file_post, geometry_post in zip(
+            df["OBJECTID"],
+            df["file_pre"],
+            df["geometry_pre"],
+            df["file_post"],
+            df["geometry_post"],
+        )
+    ]
+
     filepath_labels=os.path.join(path_temp_data, 'labels.txt')
     with open(filepath_labels, 'w+') as labels_file:
         count = 0
 
-        for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-
-            # filter based on damage. Only accept described damage types. Un-classified is filtered out
-            damage = row['_damage']
-            if damage not in list_damage_types:
-                continue
-
-            # pre geom
-            #.bounds gives the bounding box around the polygon defined in row['geometry_pre']
-            bounds_pre = row['geometry_pre'].bounds
-            geoms_pre = makesquare(*bounds_pre)
-
-            # post geom
-            bounds_post = row['geometry_post'].bounds
-            geoms_post = makesquare(*bounds_post)
-
-            # identify data point
-            objectID = row['OBJECTID']
-
-            try:
-                #call function to crop the image to the building, which in turn calls function to save the cropped image
-                before_file = getImage(os.path.join(path_images_before, row['file_pre']), geoms_pre,'before','{}.png'.format(objectID),path_temp_data)
-                after_file = getImage(os.path.join(path_images_after, row['file_post']), geoms_post,'after', '{}.png'.format(objectID),path_temp_data)
-                if (before_file is not None) and os.path.isfile(before_file) and (after_file is not None) \
-                        and os.path.isfile(after_file):
-                    labels_file.write('{0}.png {1:.4f}\n'.format(objectID, damage_quantifier(damage,label_type)))
-                    count += 1
-            except ValueError as ve:
-                    continue
+        # labels are written by this process in dataframe order, so the labels file does not depend on the number of workers
+        results = extractDatapoints(
+            datapoints,
+            path_temp_data,
+            workers=workers,
+            block_cache_size=block_cache_size,
+        )
+        for datapoint, damage, extracted in zip(
+            datapoints, df["_damage"], tqdm(results, total=len(datapoints))
+        ):
+            if extracted:
+                labels_file.write(
+                    "{0}.png {1:.4f}\n".format(
+                        datapoint[0], damage_quantifier(damage, label_type)
+                    )
+                )
+                count += 1
 
     logger.info('Created {} Datapoints'.format(count))
     return filepath_labels
@@ -479,13 +604,37 @@ def main():
         help="Fraction of data that should be labelled as training data"
     )
 
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes used to create the image stamps",
+    )
+
+    parser.add_argument(
+        "--block-cache-size",
+        default=128,
+        type=int,
+        help="Megabytes of decoded image blocks cached per process and shared between neighbouring buildings, "
+        "0 reads every image stamp directly",
+    )
+
     args = parser.parse_args()
 
     if args.create_image_stamps or args.run_all:
         logger.info("Creating training dataset.")
         BEFORE_FOLDER, AFTER_FOLDER, JSON_FOLDER, TEMP_DATA_FOLDER = create_folders(args.input, args.output)
         df = xbd_preprocess(JSON_FOLDER, args.output, disaster_types=args.disaster)
-        LABELS_FILE = createDatapoints(df, BEFORE_FOLDER, AFTER_FOLDER, TEMP_DATA_FOLDER, args.label_type, args.damage)
+        LABELS_FILE = createDatapoints(
+            df,
+            BEFORE_FOLDER,
+            AFTER_FOLDER,
+            TEMP_DATA_FOLDER,
+            args.label_type,
+            args.damage,
+            workers=args.workers,
+            block_cache_size=args.block_cache_size,
+        )
         splitDatapoints(LABELS_FILE, args.output, TEMP_DATA_FOLDER,train_split=args.train,validation_split=args.val,test_split=args.test)
     else:
         logger.info("Skipping creation of training dataset.")
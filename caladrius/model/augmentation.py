@@ -0,0 +1,229 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def get_batch_augmentation_transforms(scale):
+    """
+    Transformations of the training images in the data loader workers when the
+    random augmentation runs on batches, see BatchAugmentation
+    Args:
+        scale (int): images are resized and center cropped to scale x scale pixels
+
+    Returns:
+        Composition of transformations giving uint8 tensors of the same size,
+        so they can be collated into a batch
+    """
+    import torchvision.transforms as transforms
+
+    return transforms.Compose(
+        [
+            transforms.Resize(scale),
+            transforms.CenterCrop(scale),
+            transforms.PILToTensor(),
+        ]
+    )
+
+
+class PairedTransform(object):
+    """
+    Applies a composition of transformations to the before and after image of a pair
+    in a single pass, with the same random parameters for both
+    The images are stacked as one 6 channel tensor for the steps before ToTensor,
+    so crops, flips and rotations are sampled once and the pair stays aligned.
+    The steps after ToTensor, like Normalize, are applied to each image.
+    """
+
+    def __init__(self, transform):
+        import torchvision.transforms as transforms
+
+        steps = list(transform.transforms)
+        position = next(
+            (
+                position
+                for position, step in enumerate(steps)
+                if isinstance(step, transforms.ToTensor)
+            ),
+            len(steps),
+        )
+        self.transform = transform
+        self.image_transform = transforms.Compose(steps[:position])
+        self.tensor_transform = transforms.Compose(steps[position + 1 :])
+
+    def __call__(self, before_image, after_image):
+        import torchvision.transforms.functional as TF
+
+        before = TF.pil_to_tensor(before_image)
+        after = TF.pil_to_tensor(after_image)
+        if after.shape[1:] != before.shape[1:]:
+            after = TF.resize(after, list(before.shape[1:]))
+        pair = self.image_transform(torch.cat([before, after]))
+        before, after = TF.convert_image_dtype(pair, torch.float).split(
+            before.size(0)
+        )
+        return self.tensor_transform(before), self.tensor_transform(after)
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.transform)
+
+
+class BatchAugmentation(object):
+    """
+    Random augmentation of batches of uint8 images, on the device of the batch
+    Samples the parameters of RandomResizedCrop, RandomHorizontalFlip, RandomVerticalFlip
+    and RandomRotation of torchvision from the same distributions, per image, and applies
+    them as a single affine resampling of the batch, followed by ToTensor and Normalize.
+    Like RandomRotation, the corners rotated out of the crop are filled with black.
+    """
+
+    def __init__(
+        self,
+        input_shape,
+        mean,
+        std,
+        degrees=90,
+        crop_scale=(0.08, 1.0),
+        crop_ratio=(3.0 / 4.0, 4.0 / 3.0),
+        paired=False,
+    ):
+        """
+        Args:
+            input_shape (int): size of the square output images
+            mean (list): mean of every channel, used to normalize the images
+            std (list): standard deviation of every channel, used to normalize the images
+            degrees (float): images are rotated by an angle between -degrees and degrees
+            crop_scale (tuple): range of the area of the crop relative to the image
+            crop_ratio (tuple): range of the aspect ratio of the crop
+            paired (bool): apply the same parameters to the before and after image of a pair
+        """
+        self.input_shape = input_shape
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.degrees = degrees
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.paired = paired
+
+    def __call__(self, image1, image2):
+        batch_size = image1.size(0)
+        images = torch.cat([image1, image2])
+        number_of_parameters = batch_size if self.paired else 2 * batch_size
+        theta, inside = self.sample(
+            number_of_parameters, images.size(2), images.size(3), images.device
+        )
+        if self.paired:
+            theta = theta.repeat(2, 1, 1)
+            inside = inside.repeat(2, 1, 1)
+        images = self.apply(images, theta, inside)
+        return images[:batch_size], images[batch_size:]
+
+    def crop_boxes(self, number, height, width, device, attempts=10):
+        """
+        Crop boxes sampled as by RandomResizedCrop.get_params, for a batch of images
+        Every image takes the first of its attempts that fits in the image,
+        images without one are cropped in the center with the clamped aspect ratio.
+
+        Returns:
+            top, left, crop height and crop width of every image
+        """
+        area = height * width
+        target_area = area * torch.empty(number, attempts, device=device).uniform_(
+            *self.crop_scale
+        )
+        log_ratio = torch.empty(number, attempts, device=device).uniform_(
+            math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1])
+        )
+        aspect_ratio = torch.exp(log_ratio)
+        crop_width = torch.round(torch.sqrt(target_area * aspect_ratio))
+        crop_height = torch.round(torch.sqrt(target_area / aspect_ratio))
+        fits = (
+            (crop_width > 0)
+            & (crop_width <= width)
+            & (crop_height > 0)
+            & (crop_height <= height)
+        )
+        # index of the first attempt that fits, 0 when none fits
+        first = (
+            fits.long() * torch.arange(attempts, 0, -1, device=device)
+        ).argmax(dim=1, keepdim=True)
+        found = fits.gather(1, first).squeeze(1)
+        crop_width = crop_width.gather(1, first).squeeze(1)
+        crop_height = crop_height.gather(1, first).squeeze(1)
+
+        # fallback to a center crop
+        ratio = width / height
+        if ratio < self.crop_ratio[0]:
+            fallback_width, fallback_height = width, round(width / self.crop_ratio[0])
+        elif ratio > self.crop_ratio[1]:
+            fallback_height = height
+            fallback_width = round(height * self.crop_ratio[1])
+        else:
+            fallback_width, fallback_height = width, height
+        crop_width = torch.where(
+            found, crop_width, torch.full_like(crop_width, fallback_width)
+        )
+        crop_height = torch.where(
+            found, crop_height, torch.full_like(crop_height, fallback_height)
+        )
+
+        random_top = torch.floor(
+            torch.rand(number, device=device) * (height - crop_height + 1)
+        )
+        random_left = torch.floor(
+            torch.rand(number, device=device) * (width - crop_width + 1)
+        )
+        top = torch.where(found, random_top, (height - crop_height) // 2)
+        left = torch.where(found, random_left, (width - crop_width) // 2)
+        return top, left, crop_height, crop_width
+
+    def sample(self, number, height, width, device):
+        """
+        Sample the augmentation of a number of images
+
+        Returns:
+            theta: affine matrices from output coordinates to coordinates in the crop
+            inside: affine matrices from crop coordinates to image coordinates,
+                all coordinates are normalized to [-1, 1]
+        """
+        top, left, crop_height, crop_width = self.crop_boxes(
+            number, height, width, device
+        )
+        # -1 flips the image, with probability 0.5
+        horizontal_flip = 1 - 2 * (torch.rand(number, device=device) < 0.5).float()
+        vertical_flip = 1 - 2 * (torch.rand(number, device=device) < 0.5).float()
+        angle = torch.deg2rad(
+            torch.empty(number, device=device).uniform_(-self.degrees, self.degrees)
+        )
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # the output is the rotated, flipped crop, map it back to the crop
+        theta = torch.zeros(number, 2, 3, device=device)
+        theta[:, 0, 0] = horizontal_flip * cos
+        theta[:, 0, 1] = -horizontal_flip * sin
+        theta[:, 1, 0] = vertical_flip * sin
+        theta[:, 1, 1] = vertical_flip * cos
+
+        inside = torch.zeros(number, 2, 3, device=device)
+        inside[:, 0, 0] = crop_width / width
+        inside[:, 0, 2] = (2 * left + crop_width) / width - 1
+        inside[:, 1, 1] = crop_height / height
+        inside[:, 1, 2] = (2 * top + crop_height) / height - 1
+        return theta, inside
+
+    def apply(self, images, theta, inside):
+        number = images.size(0)
+        grid = F.affine_grid(
+            theta,
+            (number, images.size(1), self.input_shape, self.input_shape),
+            align_corners=False,
+        )
+        # points rotated out of the crop are black, not the pixels around the crop
+        in_crop = (grid.abs() <= 1).all(dim=3).unsqueeze(1)
+        offset = inside[:, :, 2].view(number, 1, 1, 2)
+        grid = torch.einsum("nhwk,nik->nhwi", grid, inside[:, :, :2]) + offset
+        images = F.grid_sample(
+            images.float(), grid, mode="bilinear", align_corners=False
+        )
+        images = images * in_crop / 255
+        return (images - self.mean.to(images.device)) / self.std.to(images.device)
@@ -0,0 +1,356 @@
+import os
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+
+from utils import create_logger
+
+
+logger = create_logger(__name__)
+
+CACHE_INDEX_FILE = "index.npz"
+CACHE_IMAGE_FILE = "{}.npy"
+CACHE_FEATURE_FILE = "features.npy"
+
+
+def split_deterministic_transform(transform):
+    """
+    Split a composition of transformations at ToTensor
+    Args:
+        transform: transforms.Compose of the dataset
+
+    Returns:
+        image_transform: deterministic transformations applied to the PIL image,
+            None if the transformation can not be cached
+        tensor_transform: transformations applied after converting to a tensor
+    """
+    import torchvision.transforms as transforms
+
+    # transforms that give the same output every time they are applied to an image
+    deterministic_transforms = (transforms.Resize, transforms.CenterCrop)
+    if not isinstance(transform, transforms.Compose):
+        return None, transform
+    for position, step in enumerate(transform.transforms):
+        if isinstance(step, transforms.ToTensor):
+            image_transforms = transform.transforms[:position]
+            if all(
+                isinstance(image_step, deterministic_transforms)
+                for image_step in image_transforms
+            ):
+                return (
+                    transforms.Compose(image_transforms),
+                    transforms.Compose(transform.transforms[position:]),
+                )
+            break
+    return None, transform
+
+
+def dataset_version(data_path):
+    version_file_path = os.path.join(data_path, "VERSION")
+    if os.path.exists(version_file_path):
+        with open(version_file_path) as version_file:
+            return version_file.read().strip()
+    return None
+
+
+def datapoints_fingerprint(dataset):
+    if hasattr(dataset, "filenames"):
+        # CaladriusDataset and CachedCaladriusDataset
+        return "\n".join(
+            "{} {!r}".format(filename, label)
+            for filename, label in zip(dataset.filenames, dataset.labels)
+        )
+    if hasattr(dataset, "index"):
+        # PackedCaladriusDataset
+        return "\n".join(
+            "{} {!r}".format(filename, label)
+            for filename, label in zip(
+                dataset.index["filenames"], dataset.index["labels"]
+            )
+        )
+    raise ValueError("{} has no datapoints to cache".format(type(dataset).__name__))
+
+
+def cache_key(*parts):
+    return hashlib.sha1("\n".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def state_dict_fingerprint(state_dict):
+    state_hash = hashlib.sha1()
+    for name, value in state_dict.items():
+        state_hash.update(name.encode())
+        state_hash.update(value.detach().cpu().numpy().tobytes())
+    return state_hash.hexdigest()
+
+
+class DecodedDataset(Dataset):
+    """
+    Applies the deterministic image transformations and returns uint8 arrays,
+    used to fill the cache with the data loader workers
+    """
+
+    def __init__(self, dataset, image_transform):
+        self.dataset = dataset
+        self.image_transform = image_transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        datapoint = self.dataset.load_datapoint(idx)
+        before_image = np.asarray(self.image_transform(datapoint[1]))
+        after_image = np.asarray(self.image_transform(datapoint[2]))
+        label = datapoint[3] if len(datapoint) > 3 else np.nan
+        return idx, datapoint[0], before_image, after_image, label
+
+
+class CachedCaladriusDataset(Dataset):
+    """
+    Caches a dataset split after its deterministic transformations (Resize and CenterCrop)
+    as memory mapped uint8 arrays on disk, only ToTensor and Normalize are applied on read.
+    The cache is keyed on the transformations, the input size, the dataset version and
+    the list of datapoints, so it is rebuilt when any of them changes.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        transform,
+        cache_path,
+        data_path,
+        input_size,
+        number_of_workers=0,
+        batch_size=32,
+    ):
+        self.set_name = dataset.set_name
+        image_transform, self.transforms = split_deterministic_transform(transform)
+        if image_transform is None:
+            raise ValueError(
+                "{} transformations are not deterministic and can not be cached".format(
+                    self.set_name
+                )
+            )
+
+        key = cache_key(
+            repr(image_transform),
+            input_size,
+            dataset_version(data_path),
+            datapoints_fingerprint(dataset),
+        )
+        self.directory = os.path.join(cache_path, "{}-{}".format(self.set_name, key))
+
+        if os.path.isdir(self.directory):
+            logger.info("Using cached {} set {}".format(self.set_name, self.directory))
+        else:
+            self.build(
+                DecodedDataset(dataset, image_transform), number_of_workers, batch_size
+            )
+
+        with np.load(os.path.join(self.directory, CACHE_INDEX_FILE)) as index:
+            self.filenames = index["filenames"]
+            self.labels = index["labels"]
+        self.images = None
+
+    def build(self, decoded_dataset, number_of_workers, batch_size):
+        logger.info(
+            "Caching {} {} datapoints to {}".format(
+                len(decoded_dataset), self.set_name, self.directory
+            )
+        )
+        # filled next to the final directory so an interrupted run leaves no partial cache
+        temporary_directory = self.directory + ".tmp"
+        if os.path.isdir(temporary_directory):
+            shutil.rmtree(temporary_directory)
+        os.makedirs(temporary_directory)
+
+        filenames = [None] * len(decoded_dataset)
+        labels = np.full(len(decoded_dataset), np.nan, dtype=np.float64)
+        images = None
+        loader = DataLoader(
+            decoded_dataset, batch_size=batch_size, num_workers=number_of_workers
+        )
+        for indexes, batch_filenames, before_images, after_images, batch_labels in tqdm(
+            loader
+        ):
+            if images is None:
+                images = {
+                    moment: np.lib.format.open_memmap(
+                        os.path.join(
+                            temporary_directory, CACHE_IMAGE_FILE.format(moment)
+                        ),
+                        mode="w+",
+                        dtype=np.uint8,
+                        shape=(len(decoded_dataset),) + tuple(before_images.shape[1:]),
+                    )
+                    for moment in ("before", "after")
+                }
+            indexes = indexes.numpy()
+            images["before"][indexes] = before_images.numpy()
+            images["after"][indexes] = after_images.numpy()
+            labels[indexes] = batch_labels.numpy()
+            for idx, filename in zip(indexes, batch_filenames):
+                filenames[idx] = filename
+
+        if images is not None:
+            for image_array in images.values():
+                image_array.flush()
+        np.savez(
+            os.path.join(temporary_directory, CACHE_INDEX_FILE),
+            filenames=np.array(filenames, dtype=str),
+            labels=labels,
+        )
+        os.rename(temporary_directory, self.directory)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getstate__(self):
+        # memory maps are opened again in every data loader worker
+        state = self.__dict__.copy()
+        state["images"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = {
+                moment: np.load(
+                    os.path.join(self.directory, CACHE_IMAGE_FILE.format(moment)),
+                    mmap_mode="r",
+                )
+                for moment in ("before", "after")
+            }
+        datapoint = [
+            str(self.filenames[idx]),
+            self.transforms(np.array(self.images["before"][idx])),
+            self.transforms(np.array(self.images["after"][idx])),
+        ]
+        if self.set_name != "inference":
+            datapoint.append(float(self.labels[idx]))
+        return tuple(datapoint)
+
+
+class FrozenFeatureDataset(Dataset):
+    """
+    Caches the output of the frozen layers of the model for every datapoint of a dataset
+    split with deterministic transformations, as a memory mapped float32 array on disk.
+    Datapoints are (filename, before features, after features[, label]), to be fed to
+    the model with from_stem=True.
+    The cache is keyed on the weights of the frozen layers, the transformations,
+    the input size, the dataset version and the list of datapoints.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        transform,
+        model,
+        device,
+        cache_path,
+        data_path,
+        input_size,
+        number_of_workers=0,
+        batch_size=32,
+    ):
+        self.set_name = dataset.set_name
+        key = cache_key(
+            state_dict_fingerprint(model.stem_state_dict()),
+            repr(transform),
+            input_size,
+            dataset_version(data_path),
+            datapoints_fingerprint(dataset),
+        )
+        self.directory = os.path.join(
+            cache_path, "{}-features-{}".format(self.set_name, key)
+        )
+
+        if os.path.isdir(self.directory):
+            logger.info(
+                "Using cached {} features {}".format(self.set_name, self.directory)
+            )
+        else:
+            self.build(dataset, model, device, number_of_workers, batch_size)
+
+        with np.load(os.path.join(self.directory, CACHE_INDEX_FILE)) as index:
+            self.filenames = index["filenames"]
+            self.labels = index["labels"]
+        self.features = None
+
+    def build(self, dataset, model, device, number_of_workers, batch_size):
+        logger.info(
+            "Caching {} {} features to {}".format(
+                len(dataset), self.set_name, self.directory
+            )
+        )
+        temporary_directory = self.directory + ".tmp"
+        if os.path.isdir(temporary_directory):
+            shutil.rmtree(temporary_directory)
+        os.makedirs(temporary_directory)
+
+        filenames = []
+        labels = np.full(len(dataset), np.nan, dtype=np.float64)
+        features = None
+        loader = DataLoader(
+            dataset, batch_size=batch_size, num_workers=number_of_workers
+        )
+
+        training = model.training
+        model = model.to(device)
+        model.eval()
+        offset = 0
+        with torch.no_grad():
+            for batch in tqdm(loader):
+                image1 = batch[1].to(device)
+                image2 = batch[2].to(device)
+                left_features, right_features = model.stem(image1, image2)
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        os.path.join(temporary_directory, CACHE_FEATURE_FILE),
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(len(dataset), 2) + tuple(left_features.shape[1:]),
+                    )
+                next_offset = offset + len(batch[0])
+                features[offset:next_offset, 0] = left_features.cpu().numpy()
+                features[offset:next_offset, 1] = right_features.cpu().numpy()
+                if len(batch) > 3:
+                    labels[offset:next_offset] = batch[3].numpy()
+                filenames.extend(batch[0])
+                offset = next_offset
+        model.train(training)
+
+        if features is not None:
+            features.flush()
+        np.savez(
+            os.path.join(temporary_directory, CACHE_INDEX_FILE),
+            filenames=np.array(filenames, dtype=str),
+            labels=labels,
+        )
+        os.rename(temporary_directory, self.directory)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getstate__(self):
+        # memory maps are opened again in every data loader worker
+        state = self.__dict__.copy()
+        state["features"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self.features is None:
+            self.features = np.load(
+                os.path.join(self.directory, CACHE_FEATURE_FILE), mmap_mode="r"
+            )
+        features = np.array(self.features[idx])
+        datapoint = [
+            str(self.filenames[idx]),
+            torch.from_numpy(features[0]),
+            torch.from_numpy(features[1]),
+        ]
+        if self.set_name != "inference":
+            datapoint.append(float(self.labels[idx]))
+        return tuple(datapoint)
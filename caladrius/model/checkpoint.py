@@ -0,0 +1,132 @@
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(value, copies=None):
+    """
+    Copy of a state dict (or any nesting of dicts, lists and tuples of tensors) on the CPU,
+    which stays unchanged while training continues
+    Tensors with the same memory, like the weights of a shared backbone, are copied once
+    so they are also saved once.
+    """
+    if copies is None:
+        copies = {}
+    if torch.is_tensor(value):
+        key = (value.device, value.data_ptr(), value.dtype, value.shape, value.stride())
+        if key not in copies:
+            copies[key] = value.detach().to("cpu", copy=True)
+        return copies[key]
+    if isinstance(value, dict):
+        return type(value)((key, snapshot(item, copies)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item, copies) for item in value)
+    return value
+
+
+def rng_state():
+    """
+    State of all random number generators, stored as tensors and plain values only
+    """
+    numpy_state = np.random.get_state()
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "numpy": [
+            numpy_state[0],
+            torch.from_numpy(numpy_state[1].astype(np.int64)),
+            numpy_state[2],
+            numpy_state[3],
+            numpy_state[4],
+        ],
+        "random": list(random.getstate()),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and state["cuda"]:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    numpy_state = state["numpy"]
+    np.random.set_state(
+        (
+            numpy_state[0],
+            numpy_state[1].numpy().astype(np.uint32),
+            numpy_state[2],
+            numpy_state[3],
+            numpy_state[4],
+        )
+    )
+    version, internal_state, gauss_next = state["random"]
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints with torch.save on a background thread, so training continues
+    while they are written. Each checkpoint is written to a temporary file which then
+    replaces the previous one, so an interrupted write never leaves a corrupt checkpoint.
+    At most one checkpoint per path waits to be written, a newer one replaces it,
+    so memory does not grow when writing falls behind training.
+    """
+
+    def __init__(self):
+        # paths to write, the checkpoint of every path is kept in pending
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path = item
+                with self.lock:
+                    checkpoint = self.pending.pop(path)
+                temporary_path = path + ".tmp"
+                torch.save(checkpoint, temporary_path)
+                os.replace(temporary_path, path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, checkpoint, path):
+        """
+        Queue a checkpoint for saving
+        Args:
+            checkpoint: object to save, must not change afterwards, see snapshot
+            path (str): file to save the checkpoint to
+        """
+        self.raise_error()
+        with self.lock:
+            queued = path in self.pending
+            self.pending[path] = checkpoint
+        if not queued:
+            self.queue.put(path)
+
+    def wait(self):
+        """
+        Wait until all queued checkpoints are written
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
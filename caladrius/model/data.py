@@ -1,53 +1,342 @@
+import io
 import os
+import mmap
+import numpy as np
 from PIL import Image
-from tqdm import tqdm
 
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+from utils import main_process_first
+from model.cache import CachedCaladriusDataset
+from model.augmentation import PairedTransform
+from model.inference import paired_filenames
+
+
+def read_labels(labels_path):
+    """
+    Parse a labels.txt file with a "filename label" line per datapoint
+    Returns:
+        array of filenames, float32 array of labels
+    """
+    with open(labels_path) as labels_file:
+        tokens = labels_file.read().split()
+    return np.array(tokens[0::2], dtype=str), np.array(tokens[1::2], dtype=np.float32)
 
 
 class CaladriusDataset(Dataset):
+    """
+    Before and after images of a dataset split, with the filenames and labels kept
+    in two NumPy arrays instead of a Python string per datapoint, so the data loader
+    workers share them with the main process without copying
+    """
+
     def __init__(self, directory, set_name, transforms=None, max_data_points=None):
         self.set_name = set_name
         self.directory = os.path.join(directory, set_name)
+        self.before_directory = os.path.join(self.directory, "before", "")
+        self.after_directory = os.path.join(self.directory, "after", "")
         if self.set_name == "inference":
-            self.datapoints = [
-                filename
-                for filename in tqdm(os.listdir(os.path.join(self.directory, "before")))
-            ]
+            # pairs with both a before and an after image, cached next to the images
+            self.filenames = paired_filenames(self.directory)
+            # the inference set has no labels, as in packed datasets
+            self.labels = np.full(len(self.filenames), np.nan, dtype=np.float32)
         else:
-            with open(os.path.join(self.directory, "labels.txt")) as labels_file:
-                self.datapoints = [x.strip() for x in tqdm(labels_file.readlines())]
+            self.filenames, self.labels = read_labels(
+                os.path.join(self.directory, "labels.txt")
+            )
         if max_data_points is not None:
-            self.datapoints = self.datapoints[:max_data_points]
+            self.filenames = self.filenames[:max_data_points]
+            self.labels = self.labels[:max_data_points]
         self.transforms = transforms
 
     def __len__(self):
-        return len(self.datapoints)
+        return len(self.filenames)
 
     def __getitem__(self, idx):
         datapoint = self.load_datapoint(idx)
 
-        if self.transforms:
+        if isinstance(self.transforms, PairedTransform):
+            datapoint[1], datapoint[2] = self.transforms(datapoint[1], datapoint[2])
+        elif self.transforms:
             datapoint[1] = self.transforms(datapoint[1])
             datapoint[2] = self.transforms(datapoint[2])
 
         return tuple(datapoint)
 
+    def filenames_and_labels(self):
+        """
+        Filenames and labels of all datapoints, read from labels.txt without opening images
+        """
+        return self.filenames.tolist(), self.labels.tolist()
+
     def load_datapoint(self, idx):
-        line = self.datapoints[idx]
+        filename = str(self.filenames[idx])
+        before_image = Image.open(self.before_directory + filename)
+        after_image = Image.open(self.after_directory + filename)
         if self.set_name == "inference":
-            filename = line
+            datapoint = [filename, before_image, after_image]
         else:
-            filename, damage = line.split(" ")
-        before_image = Image.open(os.path.join(self.directory, "before", filename))
-        after_image = Image.open(os.path.join(self.directory, "after", filename))
+            datapoint = [filename, before_image, after_image, float(self.labels[idx])]
+        return datapoint
+
+
+PACKED_INDEX_FILE = "index.npz"
+PACKED_SHARD_FILE = "shard_{:05d}.bin"
+
+
+class PackedCaladriusDataset(Dataset):
+    """
+    Same datapoints as CaladriusDataset, read from a set packed by pack_dataset.py:
+    the before and after PNG files of all datapoints are concatenated in a few large
+    shard files, and index.npz holds the filename, label, shard and byte offsets
+    of every datapoint. Shards are memory mapped once per data loader worker.
+    """
+
+    def __init__(self, directory, set_name, transforms=None, max_data_points=None):
+        self.set_name = set_name
+        self.directory = os.path.join(directory, set_name)
+        with np.load(os.path.join(self.directory, PACKED_INDEX_FILE)) as index:
+            self.shard_count = int(index["shard_count"])
+            self.index = {
+                key: index[key] for key in index.files if key != "shard_count"
+            }
+        if max_data_points is not None:
+            self.index = {
+                key: value[:max_data_points] for key, value in self.index.items()
+            }
+        self.transforms = transforms
+        self.shards = None
+
+    @property
+    def labels(self):
+        return self.index["labels"]
+
+    def __len__(self):
+        return len(self.index["filenames"])
+
+    def __getstate__(self):
+        # memory maps are opened again in every data loader worker
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __getitem__(self, idx):
+        datapoint = self.load_datapoint(idx)
+
+        if isinstance(self.transforms, PairedTransform):
+            datapoint[1], datapoint[2] = self.transforms(datapoint[1], datapoint[2])
+        elif self.transforms:
+            datapoint[1] = self.transforms(datapoint[1])
+            datapoint[2] = self.transforms(datapoint[2])
+
+        return tuple(datapoint)
+
+    def filenames_and_labels(self):
+        """
+        Filenames and labels of all datapoints, read from the index without opening shards
+        """
+        return (
+            [str(filename) for filename in self.index["filenames"]],
+            [float(label) for label in self.index["labels"]],
+        )
+
+    def open_shards(self):
+        self.shards = []
+        for shard_index in range(self.shard_count):
+            with open(
+                os.path.join(self.directory, PACKED_SHARD_FILE.format(shard_index)),
+                "rb",
+            ) as shard_file:
+                self.shards.append(
+                    mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+
+    def read_image(self, shard, offset, length):
+        return Image.open(io.BytesIO(self.shards[shard][offset : offset + length]))
+
+    def load_datapoint(self, idx):
+        if self.shards is None:
+            self.open_shards()
+        filename = str(self.index["filenames"][idx])
+        shard = self.index["shards"][idx]
+        before_image = self.read_image(
+            shard, self.index["before_offsets"][idx], self.index["before_lengths"][idx]
+        )
+        after_image = self.read_image(
+            shard, self.index["after_offsets"][idx], self.index["after_lengths"][idx]
+        )
         if self.set_name == "inference":
             datapoint = [filename, before_image, after_image]
         else:
-            datapoint = [filename, before_image, after_image, float(damage)]
+            datapoint = [
+                filename,
+                before_image,
+                after_image,
+                float(self.index["labels"][idx]),
+            ]
         return datapoint
 
 
+class LabelDataset(Dataset):
+    """
+    Filenames and labels of a split without images, for the statistical models
+    which never look at the pixels
+    """
+
+    def __init__(self, filenames, labels):
+        self.filenames = filenames
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return self.filenames[idx], self.labels[idx]
+
+
+class DistributedEvalSampler(Sampler):
+    """
+    Splits a dataset over the processes without padding or shuffling,
+    so every datapoint is evaluated exactly once
+    """
+
+    def __init__(self, dataset):
+        self.indices = list(range(len(dataset)))[
+            dist.get_rank() :: dist.get_world_size()
+        ]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def label_classes(labels, output_type):
+    """
+    Damage class of every label, regression labels are binned into the three
+    damage classes RollingEval scores them in
+    """
+    labels = np.asarray(labels, dtype=np.float32)
+    if output_type == "regression":
+        return np.where(labels >= 0.7, 2, np.where(labels > 0.3, 1, 0))
+    return labels.astype(np.int64)
+
+
+class AliasSampler(Sampler):
+    """
+    Samples datapoints with replacement, with the same probability for every class,
+    each draw takes constant time using the alias method (Vose) over the datapoints
+    When started with torchrun every process draws its own share of the samples.
+    """
+
+    def __init__(self, classes, seed=0):
+        counts = np.bincount(classes)
+        weights = 1.0 / counts[classes]
+        self.probabilities, self.aliases = self.alias_table(weights)
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = 0, 1
+        if dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        self.number_of_samples = len(classes) // self.world_size
+
+    @staticmethod
+    def alias_table(weights):
+        """
+        Returns:
+            probability of keeping every drawn index, index to take otherwise
+        """
+        number = len(weights)
+        scaled = weights * number / weights.sum()
+        probabilities = np.ones(number)
+        aliases = np.arange(number)
+        small = [index for index in range(number) if scaled[index] < 1.0]
+        large = [index for index in range(number) if scaled[index] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probabilities[less] = scaled[less]
+            aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        return probabilities, aliases
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        random = np.random.RandomState((self.seed % 2 ** 32, self.epoch, self.rank))
+        indices = random.randint(len(self.probabilities), size=self.number_of_samples)
+        keep = random.rand(self.number_of_samples) < self.probabilities[indices]
+        return iter(np.where(keep, indices, self.aliases[indices]).tolist())
+
+    def __len__(self):
+        return self.number_of_samples
+
+
+class StratifiedBatchSampler(Sampler):
+    """
+    Batches with the same number of datapoints of every class, as far as the batch size
+    allows, every epoch has as many batches as a shuffled epoch
+    The datapoints of every class are visited in a shuffled order, minority classes
+    start again from the beginning once they are used up.
+    When started with torchrun every process takes its own share of the batches.
+    """
+
+    def __init__(self, classes, batch_size, seed=0):
+        self.class_indices = [
+            np.flatnonzero(classes == label) for label in np.unique(classes)
+        ]
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = 0, 1
+        if dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        self.number_of_batches = len(classes) // batch_size // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        random = np.random.RandomState((self.seed % 2 ** 32, self.epoch))
+        number_of_classes = len(self.class_indices)
+        total_batches = self.number_of_batches * self.world_size
+        # datapoints per class per batch, the remainder goes to randomly chosen classes
+        per_class = np.full(
+            (total_batches, number_of_classes), self.batch_size // number_of_classes
+        )
+        for batch in per_class:
+            extra = random.choice(
+                number_of_classes, self.batch_size % number_of_classes, replace=False
+            )
+            batch[extra] += 1
+        streams = []
+        for indices, needed in zip(self.class_indices, per_class.sum(axis=0)):
+            repeats = max(1, -(-needed // len(indices)))
+            streams.append(
+                np.concatenate([random.permutation(indices) for _ in range(repeats)])
+            )
+        offsets = np.zeros(number_of_classes, dtype=np.int64)
+        batches = []
+        for batch in per_class:
+            indices = []
+            for label, count in enumerate(batch):
+                indices.extend(streams[label][offsets[label] : offsets[label] + count])
+                offsets[label] += count
+            random.shuffle(indices)
+            batches.append([int(index) for index in indices])
+        return iter(batches[self.rank :: self.world_size])
+
+    def __len__(self):
+        return self.number_of_batches
+
+
 class Datasets(object):
     def __init__(self, args, transforms):
         self.args = args
@@ -56,21 +345,101 @@ class Datasets(object):
         self.transforms = transforms
         self.number_of_workers = args.number_of_workers
         self.max_data_points = args.max_data_points
+        self.packed_data_path = args.packed_data_path
+        self.transform_cache_path = args.transform_cache_path
+        self.input_size = args.input_size
+        self.distributed = args.distributed
+        self.seed = args.torch_seed
+        self.sampler = args.sampler
+        self.output_type = args.output_type
 
     def load(self, set_name):
         assert set_name in {"train", "validation", "test", "inference"}
-        dataset = CaladriusDataset(
-            self.data_path,
-            set_name,
-            transforms=self.transforms[set_name],
-            max_data_points=self.max_data_points,
+        dataset_class = CaladriusDataset
+        data_path = self.data_path
+        if self.packed_data_path is not None:
+            dataset_class = PackedCaladriusDataset
+            data_path = self.packed_data_path
+        if self.transform_cache_path is not None and set_name != "train":
+            with main_process_first():
+                dataset = CachedCaladriusDataset(
+                    dataset_class(
+                        data_path, set_name, max_data_points=self.max_data_points
+                    ),
+                    self.transforms[set_name],
+                    self.transform_cache_path,
+                    data_path,
+                    self.input_size,
+                    number_of_workers=self.number_of_workers,
+                    batch_size=self.batch_size,
+                )
+        else:
+            dataset = dataset_class(
+                data_path,
+                set_name,
+                transforms=self.transforms[set_name],
+                max_data_points=self.max_data_points,
+            )
+        return dataset, self.data_loader(dataset, set_name)
+
+    def load_labels(self, set_name):
+        """
+        Load the filenames and labels of a split, without decoding any image
+        Args:
+            set_name (str): "train", "validation", "test" or "inference"
+
+        Returns:
+            LabelDataset of the split and a data loader of (filenames, labels) batches,
+            sampled like the batches of load
+        """
+        assert set_name in {"train", "validation", "test", "inference"}
+        dataset_class = CaladriusDataset
+        data_path = self.data_path
+        if self.packed_data_path is not None:
+            dataset_class = PackedCaladriusDataset
+            data_path = self.packed_data_path
+        dataset = LabelDataset(
+            *dataset_class(
+                data_path, set_name, max_data_points=self.max_data_points
+            ).filenames_and_labels()
         )
-        data_loader = DataLoader(
+        # batches of labels are cheap, workers would only add start up time
+        return dataset, self.data_loader(dataset, set_name, number_of_workers=0)
+
+    def data_loader(self, dataset, set_name, number_of_workers=None):
+        if number_of_workers is None:
+            number_of_workers = self.number_of_workers
+        if set_name == "train" and self.sampler != "shuffle":
+            # class balanced training, see --sampler
+            classes = label_classes(dataset.labels, self.output_type)
+            if self.sampler == "weighted":
+                return DataLoader(
+                    dataset,
+                    batch_size=self.batch_size,
+                    sampler=AliasSampler(classes, seed=self.seed),
+                    num_workers=number_of_workers,
+                    drop_last=True,
+                )
+            return DataLoader(
+                dataset,
+                batch_sampler=StratifiedBatchSampler(
+                    classes, self.batch_size, seed=self.seed
+                ),
+                num_workers=number_of_workers,
+            )
+        sampler = None
+        if self.distributed:
+            # every process loads its own share of the data
+            if set_name == "train":
+                sampler = DistributedSampler(dataset, shuffle=True, seed=self.seed)
+            else:
+                sampler = DistributedEvalSampler(dataset)
+        return DataLoader(
             dataset,
             batch_size=self.batch_size,
-            shuffle=(set_name == "train"),
-            num_workers=self.number_of_workers,
-            drop_last=True,
+            shuffle=(set_name == "train" and sampler is None),
+            sampler=sampler,
+            num_workers=number_of_workers,
+            # every validation and test datapoint is scored, see DistributedEvalSampler
+            drop_last=(set_name == "train"),
         )
-
-        return dataset, data_loader
@@ -1,80 +1,140 @@
-from sklearn.metrics import precision_recall_fscore_support, accuracy_score
 import torch
+import torch.distributed as dist
 
-from utils import create_logger
+from utils import create_logger, collective_device
 
 
 logger = create_logger(__name__)
 
 
 class RollingEval(object):
-    def __init__(self, output_type):
+    """
+    Accumulates the confusion matrix of an epoch batch by batch,
+    all scores are computed from it the same way as sklearn.metrics,
+    over the classes present in the labels or predictions
+    """
+
+    def __init__(self, output_type, n_classes=None):
         self.output_type = output_type
-        self.labels = torch.Tensor([])
-        self.predictions = torch.Tensor([])
         self.total_loss = 0.0
+        self.total_number = 0
 
         # default damage class boundaries
         self.upper_bound = 0.7
         self.lower_bound = 0.3
 
+        # regression outputs are scored as three damage classes, see to_classes
+        self.n_classes = 3 if self.output_type == "regression" else n_classes
+        self.confusion_matrix = torch.zeros(
+            (self.n_classes, self.n_classes), dtype=torch.long
+        )
+        self.batch_confusion_matrix = None
+
     def add(self, labels, predictions, loss):
-        self.labels = self.labels.to(labels.device)
-        self.predictions = self.predictions.to(predictions.device)
         if self.output_type == "regression":
-            self.labels = self.labels.float()
-            self.predictions = self.predictions.float()
-            labels = labels.float()
-            predictions = predictions.float()
-        else:
-            self.labels = self.labels.long()
-            self.predictions = self.predictions.long()
-            labels = labels.long()
-            predictions = predictions.long()
-        self.labels = torch.cat([self.labels, labels], dim=0)
-        self.predictions = torch.cat([self.predictions, predictions], dim=0)
+            labels = self.to_classes(labels.float())
+            predictions = self.to_classes(predictions.float())
+        labels = labels.long().view(-1)
+        predictions = predictions.long().view(-1)
+        self.batch_confusion_matrix = torch.bincount(
+            labels * self.n_classes + predictions, minlength=self.n_classes ** 2
+        ).view(self.n_classes, self.n_classes)
+        self.confusion_matrix += self.batch_confusion_matrix.cpu()
         self.total_loss += loss * predictions.size(0)
-        batch_score = self.score((labels, predictions))
-        return batch_score
+        self.total_number += predictions.size(0)
 
-    def to_classes(self, score):
-        score[score >= self.upper_bound] = 2
-        score[(score > self.lower_bound) & (score < self.upper_bound)] = 1
-        score[score <= self.lower_bound] = 0
-        return score
-
-    def score(self, labels_predictions=None):
-        if labels_predictions is None:
-            labels_predictions = (self.labels, self.predictions)
-        labels, predictions = labels_predictions
-        if self.output_type == "regression":
-            labels = self.to_classes(labels)
-            predictions = self.to_classes(predictions)
-        return self.precision_recall_fscore_support_accuracy(labels, predictions)
+    def all_reduce(self):
+        """
+        Sum the confusion matrices and losses of all processes, when started with torchrun
+        """
+        if not dist.is_initialized():
+            return
+        device = collective_device()
+        totals = torch.tensor(
+            [self.total_loss, self.total_number], dtype=torch.float64, device=device
+        )
+        confusion_matrix = self.confusion_matrix.to(device)
+        dist.all_reduce(confusion_matrix)
+        dist.all_reduce(totals)
+        self.confusion_matrix = confusion_matrix.cpu()
+        self.total_loss = totals[0].item()
+        self.total_number = int(totals[1].item())
 
-    def loss(self):
-        return self.total_loss / self.predictions.size(0)
-
-    def precision_recall_fscore_support_accuracy(self, labels, predictions):
-        labels = labels.cpu().detach()
-        predictions = predictions.cpu().detach()
-        accuracy_value = accuracy_score(labels, predictions, normalize=True)
-        number_of_correct = accuracy_score(labels, predictions, normalize=False)
-        total_number = len(predictions)
-        micro_precision_recall_fscore_support_values = precision_recall_fscore_support(
-            labels, predictions, average="micro"
+    def to_classes(self, score):
+        return torch.where(
+            score >= self.upper_bound,
+            torch.full_like(score, 2),
+            torch.where(
+                score > self.lower_bound,
+                torch.ones_like(score),
+                torch.zeros_like(score),
+            ),
         )
-        macro_precision_recall_fscore_support_values = precision_recall_fscore_support(
-            labels, predictions, average="macro"
+
+    def score(self):
+        return self.precision_recall_fscore_support_accuracy(self.confusion_matrix)
+
+    def batch_score(self):
+        return self.precision_recall_fscore_support_accuracy(
+            self.batch_confusion_matrix
         )
-        weighted_precision_recall_fscore_support_values = precision_recall_fscore_support(
-            labels, predictions, average="weighted"
+
+    def loss(self):
+        return self.total_loss / self.total_number
+
+    def precision_recall_fscore_support_accuracy(self, confusion_matrix):
+        """
+        Scores of a confusion matrix with labels as rows and predictions as columns
+        Returns:
+            accuracy, number of correct predictions, total number of predictions and
+            (precision, recall, f1, None) averaged micro, macro and weighted
+        """
+        confusion_matrix = confusion_matrix.cpu().double()
+        true_positives = confusion_matrix.diag()
+        label_counts = confusion_matrix.sum(1)
+        prediction_counts = confusion_matrix.sum(0)
+        # like sklearn, only the classes present in labels or predictions are scored
+        present = (label_counts + prediction_counts) > 0
+        true_positives = true_positives[present]
+        label_counts = label_counts[present]
+        prediction_counts = prediction_counts[present]
+
+        total_number = int(label_counts.sum().item())
+        number_of_correct = int(true_positives.sum().item())
+        accuracy_value = number_of_correct / total_number if total_number else 0.0
+
+        # undefined scores are 0, as with sklearn's default zero_division
+        precision = true_positives / prediction_counts.clamp(min=1)
+        recall = true_positives / label_counts.clamp(min=1)
+        f1 = 2 * true_positives / (prediction_counts + label_counts).clamp(min=1)
+
+        micro_precision = number_of_correct / max(prediction_counts.sum().item(), 1)
+        micro_recall = number_of_correct / max(label_counts.sum().item(), 1)
+        micro_f1 = (
+            2
+            * number_of_correct
+            / max(prediction_counts.sum().item() + label_counts.sum().item(), 1)
         )
+
+        weights = label_counts / max(label_counts.sum().item(), 1)
+
+        def average(values, weights=None):
+            if len(values) == 0:
+                return 0.0
+            if weights is None:
+                return values.mean().item()
+            return (values * weights).sum().item()
+
         return (
             accuracy_value,
             number_of_correct,
             total_number,
-            micro_precision_recall_fscore_support_values,
-            macro_precision_recall_fscore_support_values,
-            weighted_precision_recall_fscore_support_values,
+            (micro_precision, micro_recall, micro_f1, None),
+            (average(precision), average(recall), average(f1), None),
+            (
+                average(precision, weights),
+                average(recall, weights),
+                average(f1, weights),
+                None,
+            ),
         )
@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+from utils import create_logger
+
+
+logger = create_logger(__name__)
+
+PAIRS_INDEX_FILE = "pairs_index.npz"
+
+
+def scan_filenames(directory):
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+
+def paired_filenames(directory):
+    """
+    Filenames of the images in both the before and after subdirectories of a directory
+    The result is cached in pairs_index.npz in the directory, keyed on the modification
+    times of the before and after directories, which change when a file is added or removed.
+    Args:
+        directory (str): directory with before and after subdirectories
+
+    Returns:
+        sorted array of filenames
+    """
+    before_directory = os.path.join(directory, "before")
+    after_directory = os.path.join(directory, "after")
+    modification_times = np.array(
+        [
+            os.stat(before_directory).st_mtime_ns,
+            os.stat(after_directory).st_mtime_ns,
+        ],
+        dtype=np.int64,
+    )
+    index_path = os.path.join(directory, PAIRS_INDEX_FILE)
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if np.array_equal(index["modification_times"], modification_times):
+                return index["filenames"]
+
+    before_filenames = scan_filenames(before_directory)
+    after_filenames = scan_filenames(after_directory)
+    filenames = np.array(sorted(before_filenames & after_filenames), dtype=str)
+    if len(filenames) < len(before_filenames):
+        logger.warning(
+            "Skipping {} before images without an after image in {}".format(
+                len(before_filenames) - len(filenames), directory
+            )
+        )
+    try:
+        # written next to the index and renamed, so readers never see a partial file
+        temporary_index_path = index_path + ".tmp"
+        with open(temporary_index_path, "wb") as index_file:
+            np.savez(
+                index_file,
+                filenames=filenames,
+                modification_times=modification_times,
+            )
+        os.replace(temporary_index_path, index_path)
+    except OSError as error:
+        logger.debug("Not caching the image pairs of {}: {}".format(directory, error))
+    return filenames
+
+
+def inference_pairs(source):
+    """
+    List the before and after image pairs to run inference on
+    Args:
+        source: directory with before and after subdirectories holding images with the same filenames,
+            text file with a "before_path after_path" pair per line (relative to the file),
+            or list of (before_path, after_path) tuples
+
+    Returns:
+        list of (filename, before_path, after_path), filename is the name of the before image
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        before_directory = os.path.join(source, "before")
+        after_directory = os.path.join(source, "after")
+        filenames = paired_filenames(source).tolist()
+        return [
+            (
+                filename,
+                os.path.join(before_directory, filename),
+                os.path.join(after_directory, filename),
+            )
+            for filename in filenames
+        ]
+    if isinstance(source, str):
+        pairs_directory = os.path.dirname(source)
+        with open(source) as pairs_file:
+            pairs = [line.split() for line in pairs_file if line.strip()]
+        pairs = [
+            tuple(os.path.join(pairs_directory, path) for path in pair)
+            for pair in pairs
+        ]
+    else:
+        pairs = list(source)
+    return [
+        (os.path.basename(before_path), before_path, after_path)
+        for before_path, after_path in pairs
+    ]
+
+
+class InferenceDataset(Dataset):
+    def __init__(self, pairs, transforms=None):
+        self.pairs = pairs
+        self.transforms = transforms
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, idx):
+        filename, before_path, after_path = self.pairs[idx]
+        before_image = Image.open(before_path)
+        after_image = Image.open(after_path)
+        if self.transforms:
+            before_image = self.transforms(before_image)
+            after_image = self.transforms(after_image)
+        return filename, before_image, after_image
+
+
+def prefetch_to_device(loader, device):
+    """
+    Yields the batches of a data loader with the images already on the device
+    The transfer of the next batch is started before the current batch is yielded,
+    on a separate CUDA stream, so it overlaps with the forward pass.
+    """
+    stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def transfer(batch):
+        if batch is None:
+            return None
+        filename, image1, image2 = batch
+        if stream is None:
+            return filename, image1.to(device), image2.to(device)
+        with torch.cuda.stream(stream):
+            return (
+                filename,
+                image1.to(device, non_blocking=True),
+                image2.to(device, non_blocking=True),
+            )
+
+    iterator = iter(loader)
+    batch = transfer(next(iterator, None))
+    while batch is not None:
+        if stream is not None:
+            torch.cuda.current_stream(device).wait_stream(stream)
+            # the images are used on the current stream, keep their memory until done
+            batch[1].record_stream(torch.cuda.current_stream(device))
+            batch[2].record_stream(torch.cuda.current_stream(device))
+        next_batch = transfer(next(iterator, None))
+        yield batch
+        batch = next_batch
+
+
+def stream_predictions(
+    predict_batch, source, transforms, device, batch_size=32, number_of_workers=0
+):
+    """
+    Generator of the predictions for every image pair of the source, in order
+    Images are decoded by the data loader workers while the model runs, and every
+    pair is predicted exactly once, including the last incomplete batch.
+    Args:
+        predict_batch: function of a batch of before and after images returning predictions
+        source: directory, pairs file or list of pairs, see inference_pairs,
+            or a dataset of (filename, before image, after image) datapoints,
+            e.g. the packed or cached inference set of Datasets.load
+        transforms: transformations applied to the before and after images,
+            not used for a dataset, which applies its own
+        device: device to run the model on
+        batch_size (int): number of pairs per forward pass
+        number_of_workers (int): number of data loader workers decoding images
+
+    Yields:
+        (filename, prediction) for each pair
+    """
+    dataset = source
+    if not isinstance(source, Dataset):
+        dataset = InferenceDataset(inference_pairs(source), transforms=transforms)
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=number_of_workers,
+        drop_last=False,
+        pin_memory=(device.type == "cuda"),
+    )
+    with torch.no_grad():
+        for filename, image1, image2 in prefetch_to_device(loader, device):
+            predictions = predict_batch(image1, image2)
+            yield from zip(filename, predictions.view(-1).tolist())
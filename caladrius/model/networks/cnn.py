@@ -1,6 +1,10 @@
+import torch
 from torch import nn
-import torchvision.transforms as transforms
 
+from model.augmentation import (
+    BatchAugmentation,
+    get_batch_augmentation_transforms,
+)
 from utils import create_logger
 
 
@@ -16,6 +20,8 @@ def get_cnn_transforms(set_name):
     Returns:
         Composition of transformations for given set name
     """
+    import torchvision.transforms as transforms
+
     mean = [0.5, 0.5, 0.5]
     std = [0.5, 0.5, 0.5]
     scale = 70
@@ -49,6 +55,26 @@ def get_cnn_transforms(set_name):
     }[set_name]
 
 
+def get_cnn_batch_augmentation(paired=False):
+    """
+    Batched alternative to the random augmentation of the "train" transformations
+    Args:
+        paired (bool): apply the same augmentation to the before and after image of a pair
+
+    Returns:
+        transformations of the training images in the data loader workers,
+        BatchAugmentation of the collated batches of training images
+    """
+    mean = [0.5, 0.5, 0.5]
+    std = [0.5, 0.5, 0.5]
+    scale = 70
+    input_shape = 64
+    return (
+        get_batch_augmentation_transforms(scale),
+        BatchAugmentation(input_shape, mean, std, degrees=90, paired=paired),
+    )
+
+
 class CNN(nn.Module):
     def __init__(self, output_size):
         super().__init__()
@@ -69,7 +95,7 @@ class CNN(nn.Module):
         x = self.pool(self.relu(self.conv_1_bn(self.conv1(x))))  # B x 16 x 32 x 32
         x = self.pool(self.relu(self.conv_2_bn(self.conv2(x))))  # B x 32 x 16 x 16
         x = self.pool(self.relu(self.conv_3_bn(self.conv3(x))))  # B x 64 x  8 x  8
-        x = x.view(-1, 4096)  # B x 4096
+        x = torch.flatten(x, 1)  # B x 4096, also for channels_last tensors
         x = self.relu(self.linear1(x))  # B x 1024
         x = self.linear2(x)  # B x output_size
         return x
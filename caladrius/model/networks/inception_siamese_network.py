@@ -1,10 +1,13 @@
 from collections import OrderedDict
 
 import torch
-import torchvision
 from torch import nn
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 
+from model.augmentation import (
+    BatchAugmentation,
+    get_batch_augmentation_transforms,
+)
 from utils import create_logger
 
 
@@ -20,6 +23,8 @@ def get_pretrained_iv3(output_size):
     Returns:
         model_conv: Model with Inception_v3 as base
     """
+    import torchvision
+
     # fetch pretrained inception_v3 model
     model_conv = torchvision.models.inception_v3(pretrained=True)
 
@@ -46,6 +51,70 @@ def get_pretrained_iv3(output_size):
     return model_conv
 
 
+# layers frozen by get_pretrained_iv3
+FROZEN_STEM_LAYERS = [
+    "Conv2d_1a_3x3",
+    "Conv2d_2a_3x3",
+    "Conv2d_2b_3x3",
+    "Conv2d_3b_1x1",
+    "Conv2d_4a_3x3",
+]
+
+
+def iv3_stem(model_conv, x):
+    """
+    First half of the Inception_v3 forward pass, through the frozen layers
+    Args:
+        model_conv: Inception_v3 model
+        x: batch of N x 3 x 299 x 299 images
+
+    Returns:
+        N x 192 x 35 x 35 activations
+    """
+    if model_conv.transform_input:
+        x_ch0 = torch.unsqueeze(x[:, 0], 1) * (0.229 / 0.5) + (0.485 - 0.5) / 0.5
+        x_ch1 = torch.unsqueeze(x[:, 1], 1) * (0.224 / 0.5) + (0.456 - 0.5) / 0.5
+        x_ch2 = torch.unsqueeze(x[:, 2], 1) * (0.225 / 0.5) + (0.406 - 0.5) / 0.5
+        x = torch.cat((x_ch0, x_ch1, x_ch2), 1)
+    x = model_conv.Conv2d_1a_3x3(x)
+    x = model_conv.Conv2d_2a_3x3(x)
+    x = model_conv.Conv2d_2b_3x3(x)
+    x = F.max_pool2d(x, kernel_size=3, stride=2)
+    x = model_conv.Conv2d_3b_1x1(x)
+    x = model_conv.Conv2d_4a_3x3(x)
+    x = F.max_pool2d(x, kernel_size=3, stride=2)
+    return x
+
+
+def iv3_tail(model_conv, x):
+    """
+    Second half of the Inception_v3 forward pass, from the output of iv3_stem
+    The auxiliary classifier is skipped, its output is not used
+    Args:
+        model_conv: Inception_v3 model
+        x: N x 192 x 35 x 35 activations
+
+    Returns:
+        N x output_size features
+    """
+    x = model_conv.Mixed_5b(x)
+    x = model_conv.Mixed_5c(x)
+    x = model_conv.Mixed_5d(x)
+    x = model_conv.Mixed_6a(x)
+    x = model_conv.Mixed_6b(x)
+    x = model_conv.Mixed_6c(x)
+    x = model_conv.Mixed_6d(x)
+    x = model_conv.Mixed_6e(x)
+    x = model_conv.Mixed_7a(x)
+    x = model_conv.Mixed_7b(x)
+    x = model_conv.Mixed_7c(x)
+    x = F.adaptive_avg_pool2d(x, (1, 1))
+    x = F.dropout(x, training=model_conv.training)
+    x = torch.flatten(x, 1)
+    x = model_conv.fc(x)
+    return x
+
+
 def get_pretrained_iv3_transforms(set_name):
     """
     Compose a series of image transformations to be performed on the input data
@@ -55,6 +124,8 @@ def get_pretrained_iv3_transforms(set_name):
     Returns:
         Composition of transformations for given set name
     """
+    import torchvision.transforms as transforms
+
     mean = [0.5, 0.5, 0.5]
     std = [0.5, 0.5, 0.5]
     scale = 360
@@ -94,6 +165,26 @@ def get_pretrained_iv3_transforms(set_name):
     }[set_name]
 
 
+def get_pretrained_iv3_batch_augmentation(paired=False):
+    """
+    Batched alternative to the random augmentation of the "train" transformations
+    Args:
+        paired (bool): apply the same augmentation to the before and after image of a pair
+
+    Returns:
+        transformations of the training images in the data loader workers,
+        BatchAugmentation of the collated batches of training images
+    """
+    mean = [0.5, 0.5, 0.5]
+    std = [0.5, 0.5, 0.5]
+    scale = 360
+    input_shape = 299
+    return (
+        get_batch_augmentation_transforms(scale),
+        BatchAugmentation(input_shape, mean, std, degrees=90, paired=paired),
+    )
+
+
 class InceptionSiameseNetwork(nn.Module):
     def __init__(
         self,
@@ -102,6 +193,8 @@ class InceptionSiameseNetwork(nn.Module):
         dropout=0.5,
         output_type="regression",
         n_classes=None,
+        frozen_stem=False,
+        shared_backbone=False,
     ):
         """
         Construct the Siamese network
@@ -110,10 +203,18 @@ class InceptionSiameseNetwork(nn.Module):
             similarity_layers_sizes (list of ints): output sizes of each similarity layer
             dropout (float): amount of dropout, same for each layer
             n_classes (int): if output type is classification, this indicates the number of classes
+            frozen_stem (bool): keep the batch normalization of the frozen layers in evaluation mode,
+                so their output does not change during training and can be cached
+            shared_backbone (bool): use the same Inception v3 model for the before and after images
         """
         super().__init__()
+        self.frozen_stem = frozen_stem
+        self.shared_backbone = shared_backbone
         self.left_network = get_pretrained_iv3(output_size)
-        self.right_network = get_pretrained_iv3(output_size)
+        if self.shared_backbone:
+            self.right_network = self.left_network
+        else:
+            self.right_network = get_pretrained_iv3(output_size)
 
         similarity_layers = OrderedDict()
         # fully connected layer where input is concatenated features of the two inception models
@@ -144,25 +245,69 @@ class InceptionSiameseNetwork(nn.Module):
         elif output_type == "classification":
             self.output = nn.Linear(hidden, n_classes)
 
-    def forward(self, image_1, image_2):
+    def train(self, mode=True):
+        super().train(mode)
+        if self.frozen_stem:
+            for network in (self.left_network, self.right_network):
+                for layer in FROZEN_STEM_LAYERS:
+                    getattr(network, layer).eval()
+        return self
+
+    def stem(self, image_1, image_2):
+        """
+        Output of the frozen layers of both networks, input of forward with from_stem=True
+        """
+        if self.shared_backbone:
+            features = iv3_stem(self.left_network, torch.cat([image_1, image_2], 0))
+            return features.split([image_1.shape[0], image_2.shape[0]])
+        return iv3_stem(self.left_network, image_1), iv3_stem(
+            self.right_network, image_2
+        )
+
+    def stem_state_dict(self):
+        return OrderedDict(
+            (name, value)
+            for name, value in self.state_dict().items()
+            if name.split(".")[1] in FROZEN_STEM_LAYERS
+        )
+
+    def forward(self, image_1, image_2, from_stem=False):
         """
         Define the feedforward sequence
         Args:
             image_1: Image fed in to left network
             image_2: Image fed in to right network
+            from_stem (bool): the inputs are the outputs of stem instead of images
 
         Returns:
             Predicted output
         """
-        left_features = self.left_network(image_1)
-        right_features = self.right_network(image_2)
-
-        # for some weird reason, iv3 returns both
-        # the 1000 class softmax AND the n_classes softmax
-        # if train = True, so this is filthy, but necessary
-        if self.training:
-            left_features = left_features[0]
-            right_features = right_features[0]
+        if self.shared_backbone:
+            # one forward pass over the before and after images together
+            images = torch.cat([image_1, image_2], 0)
+            if from_stem:
+                features = iv3_tail(self.left_network, images)
+            else:
+                features = self.left_network(images)
+                # iv3 also returns the auxiliary output in training, see below
+                if self.training:
+                    features = features[0]
+            left_features, right_features = features.split(
+                [image_1.shape[0], image_2.shape[0]]
+            )
+        elif from_stem:
+            left_features = iv3_tail(self.left_network, image_1)
+            right_features = iv3_tail(self.right_network, image_2)
+        else:
+            left_features = self.left_network(image_1)
+            right_features = self.right_network(image_2)
+
+            # for some weird reason, iv3 returns both
+            # the 1000 class softmax AND the n_classes softmax
+            # if train = True, so this is filthy, but necessary
+            if self.training:
+                left_features = left_features[0]
+                right_features = right_features[0]
 
         features = torch.cat([left_features, right_features], 1)
         sim_features = self.similarity(features)
@@ -3,7 +3,7 @@ from collections import OrderedDict
 import torch
 from torch import nn
 
-from model.networks.cnn import CNN, get_cnn_transforms
+from model.networks.cnn import CNN, get_cnn_transforms, get_cnn_batch_augmentation
 
 from utils import create_logger
 
@@ -15,6 +15,10 @@ def get_light_siamese_transforms(*args):
     return get_cnn_transforms(*args)
 
 
+def get_light_siamese_batch_augmentation(*args, **kwargs):
+    return get_cnn_batch_augmentation(*args, **kwargs)
+
+
 def get_cnn(output_size):
     """
     Get a light CNN model
@@ -40,6 +44,7 @@ class LightSiameseNetwork(nn.Module):
         dropout=0.5,
         output_type="regression",
         n_classes=None,
+        shared_backbone=False,
     ):
         """
         Construct the Siamese network
@@ -48,10 +53,15 @@ class LightSiameseNetwork(nn.Module):
             similarity_layers_sizes (list of ints): output sizes of each similarity layer
             dropout (float): amount of dropout, same for each layer
             n_classes (int): if output type is classification, this indicates the number of classes
+            shared_backbone (bool): use the same CNN for the before and after images
         """
         super().__init__()
+        self.shared_backbone = shared_backbone
         self.left_network = get_cnn(output_size)
-        self.right_network = get_cnn(output_size)
+        if self.shared_backbone:
+            self.right_network = self.left_network
+        else:
+            self.right_network = get_cnn(output_size)
 
         similarity_layers = OrderedDict()
         similarity_layers["layer_0"] = nn.Linear(
@@ -89,8 +99,15 @@ class LightSiameseNetwork(nn.Module):
         Returns:
             Predicted output
         """
-        left_features = self.left_network(image_1)
-        right_features = self.right_network(image_2)
+        if self.shared_backbone:
+            # one forward pass over the before and after images together
+            features = self.left_network(torch.cat([image_1, image_2], 0))
+            left_features, right_features = features.split(
+                [image_1.shape[0], image_2.shape[0]]
+            )
+        else:
+            left_features = self.left_network(image_1)
+            right_features = self.right_network(image_2)
 
         features = torch.cat([left_features, right_features], 1)
         sim_features = self.similarity(features)
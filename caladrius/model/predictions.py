@@ -0,0 +1,270 @@
+import os
+import shutil
+import struct
+
+import numpy as np
+
+from utils import gather_list
+
+
+PREDICTION_FILENAMES_FILE = "filenames.txt"
+PREDICTION_COLUMN_FILE = "{}.npy"
+PREDICTION_SUMMARY_FILE = "summary.txt"
+
+# space reserved for the header of a .npy column, which is written once the length is known
+NPY_HEADER_SIZE = 128
+
+# size of the write buffers of prediction files
+BUFFER_SIZE = 1024 ** 2
+
+
+def to_numpy(values):
+    # tensors are recognised without importing torch, which evaluation scripts do not need
+    if hasattr(values, "detach"):
+        return values.detach().cpu().numpy()
+    return np.asarray(values)
+
+
+class TextPredictionWriter(object):
+    """
+    Writes predictions as a text file with a header and one space separated line per
+    datapoint, columns with several values per datapoint take several fields
+    """
+
+    def __init__(self, path, columns):
+        self.path = path + ".txt"
+        self.file = open(self.path, "w", buffering=BUFFER_SIZE)
+        self.file.write(" ".join(columns) + "\n")
+
+    def write(self, filenames, *columns):
+        """
+        Write a batch of predictions
+        Args:
+            filenames: filenames of the datapoints of the batch
+            columns: tensors, arrays or lists with the values of the other columns
+        """
+        columns = [to_numpy(column).tolist() for column in columns]
+        self.file.write(
+            "".join(
+                " ".join(
+                    " ".join(str(field) for field in value)
+                    if isinstance(value, list)
+                    else str(value)
+                    for value in row
+                )
+                + "\n"
+                for row in zip(filenames, *columns)
+            )
+        )
+
+    def write_summary(self, line):
+        self.file.write(line + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class NpyColumnWriter(object):
+    """
+    Appends rows to a .npy file, the header is written with the number of rows on close
+    """
+
+    def __init__(self, path, dtype=np.float32):
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        self.file.write(b"\0" * NPY_HEADER_SIZE)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = None
+        self.length = 0
+
+    def write(self, values):
+        if self.row_shape is None:
+            self.row_shape = values.shape[1:]
+        self.file.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self.length += len(values)
+
+    def close(self):
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.length,) + tuple(self.row_shape or ()),
+            }
+        )
+        magic = np.lib.format.magic(1, 0)
+        # the header is padded with spaces and ends with a newline, see numpy.lib.format
+        header_length = NPY_HEADER_SIZE - len(magic) - 2
+        header = header.ljust(header_length - 1) + "\n"
+        self.file.seek(0)
+        self.file.write(magic + struct.pack("<H", header_length) + header.encode())
+        self.file.close()
+
+
+class NpyPredictionWriter(object):
+    """
+    Writes predictions as a directory with a .npy file per column and the filenames
+    in a text file, the order of the datapoints is the same in all of them
+    All columns are float32, whichever split or writer they come from, so the predictions
+    of every split have the same schema.
+    The directory is filled next to its final path so an interrupted run leaves no partial
+    predictions.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.temporary_path = path + ".tmp"
+        if os.path.isdir(self.temporary_path):
+            shutil.rmtree(self.temporary_path)
+        os.makedirs(self.temporary_path)
+        self.filenames_file = open(
+            os.path.join(self.temporary_path, PREDICTION_FILENAMES_FILE),
+            "w",
+            buffering=BUFFER_SIZE,
+        )
+        self.columns = [
+            NpyColumnWriter(
+                os.path.join(self.temporary_path, PREDICTION_COLUMN_FILE.format(column))
+            )
+            for column in columns[1:]
+        ]
+        self.summary = []
+
+    def write(self, filenames, *columns):
+        self.filenames_file.write("".join(filename + "\n" for filename in filenames))
+        for column_writer, column in zip(self.columns, columns):
+            column_writer.write(to_numpy(column))
+
+    def write_summary(self, line):
+        self.summary.append(line + "\n")
+
+    def close(self):
+        self.filenames_file.close()
+        for column_writer in self.columns:
+            column_writer.close()
+        if self.summary:
+            with open(
+                os.path.join(self.temporary_path, PREDICTION_SUMMARY_FILE), "w"
+            ) as summary_file:
+                summary_file.writelines(self.summary)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.temporary_path, self.path)
+
+
+class GatheredPredictionWriter(object):
+    """
+    Keeps the predictions of this process until close, when the predictions of all
+    processes are gathered and written by the main process, when started with torchrun
+    """
+
+    def __init__(self, writer=None):
+        """
+        Args:
+            writer: prediction writer on the main process, None on the other processes
+        """
+        self.writer = writer
+        self.batches = []
+        self.summary = []
+
+    def write(self, filenames, *columns):
+        self.batches.append(
+            (list(filenames),) + tuple(to_numpy(column) for column in columns)
+        )
+
+    def write_summary(self, line):
+        self.summary.append(line)
+
+    def close(self):
+        batches = gather_list(self.batches)
+        if self.writer is None:
+            return
+        for batch in batches:
+            self.writer.write(*batch)
+        for line in self.summary:
+            self.writer.write_summary(line)
+        self.writer.close()
+
+
+def prediction_writer(path, columns, prediction_format="text"):
+    """
+    Open a writer to which predictions are written batch by batch
+    Args:
+        path (str): path of the predictions without extension
+        columns (list): names of the columns, starting with the filename column
+        prediction_format (str): "text" for a text file, "npy" for a directory of .npy columns
+
+    Returns:
+        writer with write(filenames, *columns), write_summary(line) and close()
+    """
+    if prediction_format == "npy":
+        return NpyPredictionWriter(path, columns)
+    return TextPredictionWriter(path, columns)
+
+
+def write_predictions(writer, predictions, batch_size=1024):
+    """
+    Write (filename, prediction) pairs to a prediction writer in batches
+    Returns:
+        number of predictions written
+    """
+    number_of_predictions = 0
+    filenames = []
+    values = []
+    for filename, prediction in predictions:
+        filenames.append(filename)
+        values.append(prediction)
+        if len(filenames) == batch_size:
+            writer.write(filenames, values)
+            number_of_predictions += len(filenames)
+            filenames = []
+            values = []
+    if filenames:
+        writer.write(filenames, values)
+        number_of_predictions += len(filenames)
+    return number_of_predictions
+
+
+def load_predictions(path):
+    """
+    Load predictions written by a prediction writer
+    Args:
+        path (str): text file or directory of .npy columns
+
+    Returns:
+        dictionary of column name to array, .npy columns are memory mapped
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, PREDICTION_FILENAMES_FILE)) as filenames_file:
+            predictions = {
+                "filename": np.array(
+                    [line.rstrip("\n") for line in filenames_file], dtype=str
+                )
+            }
+        for column_file in sorted(os.listdir(path)):
+            if column_file.endswith(".npy"):
+                predictions[column_file[: -len(".npy")]] = np.load(
+                    os.path.join(path, column_file), mmap_mode="r"
+                )
+        return predictions
+
+    with open(path) as prediction_file:
+        columns = prediction_file.readline().split()
+        # the last lines of evaluated splits hold the score of the epoch
+        rows = [
+            line.split()
+            for line in prediction_file
+            if line.strip() and not line.startswith("Epoch ")
+        ]
+    predictions = {"filename": np.array([row[0] for row in rows], dtype=str)}
+    values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(
+        len(rows), len(rows[0]) - 1 if rows else len(columns) - 1
+    )
+    for position, column in enumerate(columns[1:]):
+        if column == columns[-1]:
+            # the last column takes the remaining fields, like probabilities of all classes
+            column_values = values[:, position:]
+            if column_values.shape[1] == 1:
+                column_values = column_values[:, 0]
+            predictions[column] = column_values
+        else:
+            predictions[column] = values[:, position]
+    return predictions
@@ -0,0 +1,134 @@
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import torch
+
+from utils import create_logger
+
+logger = create_logger(__name__)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class StageTimer(object):
+    """
+    Times the stages of every batch of an epoch, see --profile-stages
+    The device is synchronized at the end of every stage, so the asynchronous CUDA work
+    is counted in the stage that started it, at the cost of some throughput.
+    When disabled the stages are not timed and nothing is synchronized.
+    """
+
+    def __init__(self, device, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        # SummaryWriter the time of every stage of every batch is written to
+        self.writer = None
+        self.phase = None
+        self.steps = {}
+        self.batch_seconds = OrderedDict()
+        self.epoch_seconds = OrderedDict()
+
+    def start_epoch(self, phase):
+        self.phase = phase
+        self.steps.setdefault(phase, 0)
+        self.batch_seconds = OrderedDict()
+        self.epoch_seconds = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            synchronize(self.device)
+            seconds = time.perf_counter() - start
+            self.batch_seconds[name] = self.batch_seconds.get(name, 0.0) + seconds
+
+    def batches(self, loader):
+        """
+        Yields the batches of a data loader, the time waiting for a batch is the "data" stage
+        """
+        iterator = iter(loader)
+        while True:
+            with self.stage("data"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+            self.end_batch()
+
+    def end_batch(self):
+        if not self.enabled:
+            return
+        for name, seconds in self.batch_seconds.items():
+            self.epoch_seconds[name] = self.epoch_seconds.get(name, 0.0) + seconds
+            if self.writer is not None:
+                self.writer.add_scalar(
+                    "Stages/{}/{}".format(self.phase.capitalize(), name),
+                    seconds,
+                    self.steps[self.phase],
+                )
+        self.steps[self.phase] += 1
+        self.batch_seconds = OrderedDict()
+
+    def end_epoch(self):
+        """
+        Returns:
+            seconds spent in every stage during the epoch, empty when disabled
+        """
+        # the wait for the end of the loader belongs to no batch, only to the epoch
+        for name, seconds in self.batch_seconds.items():
+            self.epoch_seconds[name] = self.epoch_seconds.get(name, 0.0) + seconds
+        self.batch_seconds = OrderedDict()
+        return OrderedDict(
+            (name, round(seconds, 3)) for name, seconds in self.epoch_seconds.items()
+        )
+
+
+class TraceWindow(object):
+    """
+    torch.profiler trace of a few batches, written for the tensorboard profiler plugin
+    The first batch is skipped and the second one is a warm up, so the trace shows
+    steady state batches.
+    """
+
+    def __init__(self, trace_path, number_of_batches, device):
+        self.number_of_batches = number_of_batches
+        self.steps = 0
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=1, warmup=1, active=number_of_batches, repeat=1
+            ),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_path),
+            record_shapes=True,
+        )
+
+    def __enter__(self):
+        self.profiler.__enter__()
+        return self
+
+    def __exit__(self, *exception):
+        # the trace is only written after the skipped, warm up and traced batches
+        if self.steps < self.number_of_batches + 2:
+            logger.warning(
+                "No profiler trace written, the epoch has {} batches, "
+                "--profile-trace-batches {} needs {}".format(
+                    self.steps, self.number_of_batches, self.number_of_batches + 2
+                )
+            )
+        return self.profiler.__exit__(*exception)
+
+    def step(self):
+        self.steps += 1
+        self.profiler.step()
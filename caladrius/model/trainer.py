@@ -1,28 +1,47 @@
 import os
-import copy
 import time
-import pickle
+from contextlib import nullcontext
 from datetime import datetime
 import torch
 from statistics import mode, mean
 
 from torch.optim import Adam
 from torch.nn.modules import loss as nnloss
-import torchvision.transforms as transforms
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.utils.tensorboard import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 from torch import nn
+from torch.utils.data import Dataset
 
 from model.networks.inception_siamese_network import (
     get_pretrained_iv3_transforms,
+    get_pretrained_iv3_batch_augmentation,
     InceptionSiameseNetwork,
 )
 from model.networks.light_siamese_network import (
     get_light_siamese_transforms,
+    get_light_siamese_batch_augmentation,
     LightSiameseNetwork,
 )
-from utils import create_logger, readable_float, dynamic_report_key
+from utils import (
+    create_logger,
+    readable_float,
+    dynamic_report_key,
+    is_main_process,
+    main_process_first,
+    barrier,
+    broadcast_value,
+)
 from model.evaluate import RollingEval
+from model.augmentation import PairedTransform
+from model.cache import FrozenFeatureDataset
+from model.inference import inference_pairs, stream_predictions
+from model.predictions import (
+    prediction_writer,
+    write_predictions,
+    GatheredPredictionWriter,
+)
+from model.checkpoint import CheckpointWriter, snapshot, rng_state, set_rng_state
+from model.profiler import StageTimer, TraceWindow
 
 logger = create_logger(__name__)
 
@@ -38,47 +57,137 @@ class QuasiSiameseNetwork(object):
 
         network_architecture_class = InceptionSiameseNetwork
         network_architecture_transforms = get_pretrained_iv3_transforms
+        network_architecture_batch_augmentation = get_pretrained_iv3_batch_augmentation
         if args.model_type == "light":
             network_architecture_class = LightSiameseNetwork
             network_architecture_transforms = get_light_siamese_transforms
+            network_architecture_batch_augmentation = (
+                get_light_siamese_batch_augmentation
+            )
+
+        # splits that are fed to the model as cached outputs of its frozen layers
+        self.frozen_feature_splits = {
+            "off": (),
+            "evaluation": ("validation", "test"),
+            "all": ("train", "validation", "test"),
+        }[args.frozen_feature_cache]
+        if not args.neural_model:
+            self.frozen_feature_splits = ()
+        network_arguments = {}
+        if args.shared_backbone:
+            network_arguments["shared_backbone"] = True
+        if self.frozen_feature_splits:
+            if network_architecture_class is not InceptionSiameseNetwork:
+                raise ValueError(
+                    "--frozen-feature-cache is only supported by the inception model"
+                )
+            network_arguments["frozen_stem"] = True
+        self.frozen_feature_cache_path = args.frozen_feature_cache_path
+        self.data_path = args.data_path
+        if args.packed_data_path is not None:
+            self.data_path = args.packed_data_path
+        self.input_size_argument = args.input_size
 
         # define the loss measure
         if self.output_type == "regression":
             self.criterion = nnloss.MSELoss()
-            self.model = network_architecture_class()
         elif self.output_type == "classification":
             self.criterion = nnloss.CrossEntropyLoss()
             self.n_classes = 4  # replace by args
-            self.model = network_architecture_class(
-                output_type=self.output_type, n_classes=self.n_classes
-            )
 
         self.transforms = {}
+        self.batch_augmentation = None
 
-        if torch.cuda.device_count() > 1:
-            logger.info("Using {} GPUs".format(torch.cuda.device_count()))
-            self.model = torch.nn.DataParallel(self.model)
+        self.precision = args.precision
+        self.channels_last = args.channels_last
+        self.device = args.device
 
-        for s in ("train", "validation", "test", "inference"):
-            self.transforms[s] = network_architecture_transforms(s)
+        # statistical models predict from the labels only, they have no network,
+        # no optimizer and no image transformations
+        self.model = None
+        self.network = None
+        self.optimizer = None
+        self.lr_scheduler = None
+        if not args.statistical_model:
+            if self.output_type == "regression":
+                self.model = network_architecture_class(**network_arguments)
+            elif self.output_type == "classification":
+                self.model = network_architecture_class(
+                    output_type=self.output_type,
+                    n_classes=self.n_classes,
+                    **network_arguments
+                )
 
-        logger.debug("Num params: {}".format(len([_ for _ in self.model.parameters()])))
+            if self.channels_last:
+                self.model = self.model.to(memory_format=torch.channels_last)
+
+            # the model without the DistributedDataParallel wrapper, used to save and load weights
+            self.network = self.model
+            if args.distributed:
+                logger.info("Training in {} processes".format(args.world_size))
+                self.model = DistributedDataParallel(
+                    self.model.to(self.device),
+                    device_ids=(
+                        [self.device.index] if self.device.type == "cuda" else None
+                    ),
+                    # the auxiliary classifier of inception does not contribute to the loss
+                    find_unused_parameters=(
+                        network_architecture_class is InceptionSiameseNetwork
+                    ),
+                )
 
-        self.optimizer = Adam(self.model.parameters(), lr=self.lr)
-        # reduces the learning rate when loss plateaus, i.e. doesn't improve
-        self.lr_scheduler = ReduceLROnPlateau(
-            self.optimizer, factor=0.1, patience=10, min_lr=1e-5, verbose=True
-        )
-        # creates tracking file for tensorboard
-        self.writer = SummaryWriter(args.checkpoint_path)
+            for s in ("train", "validation", "test", "inference"):
+                self.transforms[s] = network_architecture_transforms(s)
 
-        self.device = args.device
+            # the random augmentation of training batches, after collation on the device
+            if args.batch_augmentation:
+                train_transform, self.batch_augmentation = (
+                    network_architecture_batch_augmentation(
+                        paired=args.paired_augmentation
+                    )
+                )
+                self.transforms["train"] = train_transform
+            elif args.paired_augmentation:
+                # one set of random parameters for the before and after image of a pair
+                self.transforms["train"] = PairedTransform(self.transforms["train"])
+
+            if "train" in self.frozen_feature_splits:
+                # cached features need deterministic transformations, train without augmentation
+                logger.info("Training on cached frozen features, without augmentation")
+                self.transforms["train"] = network_architecture_transforms("validation")
+                self.batch_augmentation = None
+
+            logger.debug(
+                "Num params: {}".format(len([_ for _ in self.model.parameters()]))
+            )
+
+            self.optimizer = Adam(self.model.parameters(), lr=self.lr)
+            # reduces the learning rate when loss plateaus, i.e. doesn't improve
+            self.lr_scheduler = ReduceLROnPlateau(
+                self.optimizer, factor=0.1, patience=10, min_lr=1e-5, verbose=True
+            )
+        self.checkpoint_path = args.checkpoint_path
         self.model_path = args.model_path
+        self.resume_path = args.resume_path
+        self.resume = args.resume
         self.prediction_path = args.prediction_path
+        self.prediction_format = args.prediction_format
+        self.distributed = args.distributed
         self.model_type = args.model_type
         self.is_statistical_model = args.statistical_model
         self.is_neural_model = args.neural_model
         self.log_step = args.log_step
+        self.early_stopping_patience = args.early_stopping_patience
+        self.max_train_seconds = (
+            None if args.max_train_minutes is None else args.max_train_minutes * 60
+        )
+        self.validation_interval = args.validation_interval
+
+        # seconds spent in each stage of the batches, see --profile-stages
+        self.stage_timer = StageTimer(self.device, enabled=args.profile_stages)
+        self.stage_seconds = {}
+        self.profile_trace_batches = args.profile_trace_batches
+        self.profile_trace_path = os.path.join(args.checkpoint_path, "profiler")
 
     def get_random_output_values(self, output_shape):
         return torch.rand(output_shape)
@@ -93,9 +202,8 @@ class QuasiSiameseNetwork(object):
         return outputs
 
     def calculate_average_label(self, train_set):
-        list_of_labels = []
-        for _, _, _, label in train_set:
-            list_of_labels.extend([label])
+        # labels are read from the LabelDataset of load_labels, without decoding images
+        list_of_labels = list(train_set.labels)
         if self.output_type == "regression":
             average_label = mean(list_of_labels)
         elif self.output_type == "classification":
@@ -103,23 +211,89 @@ class QuasiSiameseNetwork(object):
             average_label = int(mode(list_of_labels))
         return average_label
 
-    def create_prediction_file(self, phase, epoch):
-        prediction_file_name = "{}-split_{}-epoch_{:03d}-model_{}-predictions.txt".format(
+    def load_dataset(self, datasets, set_name):
+        """
+        Load a dataset split, as cached frozen features if enabled for the split
+        Args:
+            datasets: DataSet object with datasets loaded
+            set_name (str): "train", "validation", "test" or "inference"
+
+        Returns:
+            dataset and data loader of the split, statistical models get a
+            LabelDataset and batches of filenames and labels only
+        """
+        if self.is_statistical_model:
+            return datasets.load_labels(set_name)
+        dataset, data_loader = datasets.load(set_name)
+        if set_name in self.frozen_feature_splits:
+            with main_process_first():
+                dataset = FrozenFeatureDataset(
+                    dataset,
+                    datasets.transforms[set_name],
+                    self.network,
+                    self.device,
+                    self.frozen_feature_cache_path,
+                    self.data_path,
+                    self.input_size_argument,
+                    number_of_workers=datasets.number_of_workers,
+                    batch_size=datasets.batch_size,
+                )
+            data_loader = datasets.data_loader(dataset, set_name)
+        return dataset, data_loader
+
+    def prediction_file_path(self, phase, epoch):
+        prediction_file_name = "{}-split_{}-epoch_{:03d}-model_{}-predictions".format(
             self.run_name, phase, epoch, self.model_type
         )
-        prediction_file_path = os.path.join(self.prediction_path, prediction_file_name)
-        if self.model_type != "probability":
-            prediction_file = open(prediction_file_path, "w+")
-            prediction_file.write("filename label prediction\n")
-            return prediction_file
-        else:
-            return open(prediction_file_path, "wb")
+        return os.path.join(self.prediction_path, prediction_file_name)
+
+    def create_prediction_writer(self, phase, epoch, columns):
+        """
+        Open the writer of the predictions of a split, see model.predictions
+        Args:
+            phase (str): dataset split
+            epoch (int): epoch of the predictions
+            columns (list): names of the columns, starting with the filename column
+
+        Returns:
+            prediction writer, when started with torchrun the predictions of all
+            processes are written by the main process on close
+        """
+        writer = None
+        if is_main_process():
+            writer = prediction_writer(
+                self.prediction_file_path(phase, epoch), columns, self.prediction_format
+            )
+        if self.distributed:
+            return GatheredPredictionWriter(writer)
+        return writer
+
+    def forward(self, image1, image2, from_stem):
+        if self.channels_last:
+            image1 = image1.contiguous(memory_format=torch.channels_last)
+            image2 = image2.contiguous(memory_format=torch.channels_last)
+        # bf16 has the exponent range of fp32, so gradients need no loss scaling
+        # only training steps need the gradient synchronisation of DistributedDataParallel,
+        # evaluation runs on the network alone so processes can have different batch counts
+        model = self.model if self.network.training else self.network
+        with torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.bfloat16,
+            enabled=(self.precision == "bf16"),
+        ):
+            if from_stem:
+                # the inputs are cached outputs of the frozen layers
+                outputs = model(image1, image2, from_stem=True)
+            else:
+                outputs = model(image1, image2)
+        # losses, predictions and scores are computed in fp32
+        return outputs.float()
 
     def get_outputs_preds(
-        self, image1, image2, random_target_shape, average_target_size
+        self, image1, image2, random_target_shape, average_target_size, from_stem=False
     ):
         if self.is_neural_model:
-            outputs = self.model(image1, image2).squeeze()
+            outputs = self.forward(image1, image2, from_stem).squeeze(1)
         elif self.model_type == "random":
             output_shape = (
                 random_target_shape
@@ -133,7 +307,9 @@ class QuasiSiameseNetwork(object):
             )
 
         elif self.model_type == "probability":
-            outputs = nn.functional.softmax(self.model(image1, image2), dim=1).squeeze()
+            outputs = nn.functional.softmax(
+                self.forward(image1, image2, from_stem), dim=1
+            ).squeeze(1)
 
         outputs = outputs.to(self.device)
 
@@ -144,6 +320,25 @@ class QuasiSiameseNetwork(object):
 
         return outputs, preds
 
+    def batch_to_device(self, batch):
+        """
+        Returns:
+            filenames, images and labels of a batch, on the device of the model
+        """
+        if self.is_statistical_model:
+            # the outputs of the statistical models only depend on the number of labels
+            filename, labels = batch
+            image1 = image2 = None
+        else:
+            filename, image1, image2, labels = batch
+            image1 = image1.to(self.device)
+            image2 = image2.to(self.device)
+        if self.output_type == "regression":
+            labels = labels.float()
+        else:
+            labels = labels.long()
+        return filename, image1, image2, labels.to(self.device)
+
     def run_epoch(
         self,
         epoch,
@@ -165,63 +360,95 @@ class QuasiSiameseNetwork(object):
         """
         assert phase in ("train", "validation", "test")
 
-        self.model = self.model.to(self.device)
+        if self.model is not None:
+            self.model = self.model.to(self.device)
 
-        self.model.eval()
-        if phase == "train":
-            self.model.train()  # Set model to training mode
+            self.model.eval()
+            if phase == "train":
+                self.model.train()  # Set model to training mode
 
-        rolling_eval = RollingEval(self.output_type)
+        rolling_eval = RollingEval(
+            self.output_type,
+            self.n_classes if self.output_type == "classification" else None,
+        )
 
-        prediction_file = self.create_prediction_file(phase, epoch)
+        # a different order of the datapoints every epoch
+        for sampler in (loader.sampler, loader.batch_sampler):
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)
 
         if self.model_type == "average":
             self.average_label = self.calculate_average_label(train_set)
 
+        prediction_columns = ["filename", "label", "prediction"]
         if self.model_type == "probability":
-            output_probability_list = []
-
-        for idx, (filename, image1, image2, labels) in enumerate(loader, 1):
-            image1 = image1.to(self.device)
-            image2 = image2.to(self.device)
-            if self.output_type == "regression":
-                labels = labels.float()
-            else:
-                labels = labels.long()
-            labels = labels.to(self.device)
-
-            if phase == "train":
-                # zero the parameter gradients
-                self.optimizer.zero_grad()
+            prediction_columns.append("probability")
+        prediction_file = self.create_prediction_writer(
+            phase, epoch, prediction_columns
+        )
 
-            with torch.set_grad_enabled(phase == "train"):
-                outputs, preds = self.get_outputs_preds(
-                    image1, image2, labels.shape, labels.shape
-                )
-                loss = self.criterion(outputs, labels)
+        # a torch.profiler trace of the first training batches, see --profile-trace-batches
+        trace = None
+        if phase == "train" and self.profile_trace_batches > 0 and is_main_process():
+            trace = TraceWindow(
+                self.profile_trace_path, self.profile_trace_batches, self.device
+            )
+            self.profile_trace_batches = 0
+
+        stage = self.stage_timer.stage
+        self.stage_timer.start_epoch(phase)
+        with trace or nullcontext():
+            for idx, batch in enumerate(self.stage_timer.batches(loader), 1):
+                with stage("copy"):
+                    filename, image1, image2, labels = self.batch_to_device(batch)
+                if phase == "train" and self.batch_augmentation is not None:
+                    with stage("augmentation"):
+                        image1, image2 = self.batch_augmentation(image1, image2)
 
                 if phase == "train":
-                    loss.backward()
-                    self.optimizer.step()
-
-                if self.model_type == "probability":
-                    output_probability_list.extend(outputs.tolist())
-                else:
-                    prediction_file.writelines(
-                        [
-                            "{} {} {}\n".format(*line)
-                            for line in zip(
-                                filename,
-                                labels.view(-1).tolist(),
-                                preds.view(-1).tolist(),
+                    with stage("optimizer"):
+                        # zero the parameter gradients
+                        self.optimizer.zero_grad()
+
+                with torch.set_grad_enabled(phase == "train"):
+                    with stage("forward"):
+                        outputs, preds = self.get_outputs_preds(
+                            image1,
+                            image2,
+                            labels.shape,
+                            labels.shape,
+                            from_stem=phase in self.frozen_feature_splits,
+                        )
+                    with stage("loss"):
+                        loss = self.criterion(outputs, labels)
+
+                    if phase == "train":
+                        with stage("backward"):
+                            loss.backward()
+                        with stage("optimizer"):
+                            self.optimizer.step()
+
+                    with stage("write"):
+                        if self.model_type == "probability":
+                            prediction_file.write(
+                                filename, labels.view(-1), preds.view(-1), outputs
+                            )
+                        else:
+                            prediction_file.write(
+                                filename, labels.view(-1), preds.view(-1)
                             )
-                        ]
-                    )
 
-                batch_loss = loss.item()
-                batch_score = rolling_eval.add(labels, preds, batch_loss)
+                    with stage("metrics"):
+                        batch_loss = loss.item()
+                        rolling_eval.add(labels, preds, batch_loss)
 
-            if idx % self.log_step == 0:
+                if trace is not None:
+                    trace.step()
+
+                if idx % self.log_step != 0:
+                    continue
+                with stage("metrics"):
+                    batch_score = rolling_eval.batch_score()
                 logger.debug(
                     "Epoch: {:03d} Phase: {:10s} Batch {:04d}/{:04d}: Loss: {:.4f} Accuracy: {:.4f} Correct: {:d} Total: {:d}".format(
                         epoch,
@@ -268,6 +495,23 @@ class QuasiSiameseNetwork(object):
                     )
                 )
 
+        self.stage_seconds = self.stage_timer.end_epoch()
+        if self.stage_seconds:
+            total_seconds = sum(self.stage_seconds.values())
+            logger.info(
+                "Epoch {:03d} Phase: {:10s}: Seconds per stage: {} ({:.0%} waiting for data)".format(
+                    epoch,
+                    phase,
+                    ", ".join(
+                        "{} {:.2f}".format(name, seconds)
+                        for name, seconds in self.stage_seconds.items()
+                    ),
+                    self.stage_seconds.get("data", 0.0) / max(total_seconds, 1e-9),
+                )
+            )
+
+        # scores of the whole split when the processes each ran a share of it
+        rolling_eval.all_reduce()
         epoch_loss = rolling_eval.loss()
         epoch_score = rolling_eval.score()
 
@@ -280,16 +524,13 @@ class QuasiSiameseNetwork(object):
             second_index[second_index_key]
         ]
 
-        if self.model_type == "probability":
-            pickle.dump(output_probability_list, prediction_file)
-        else:
-            prediction_file.write(
-                "Epoch {:03d} ({}) {}: {:.4f}\n".format(
+        if prediction_file is not None:
+            prediction_file.write_summary(
+                "Epoch {:03d} ({}) {}: {:.4f}".format(
                     epoch, first_index_key, second_index_key, epoch_main_metric
                 )
             )
-
-        prediction_file.close()
+            prediction_file.close()
 
         logger.info(
             "Epoch {:03d} Phase: {:10s}: Loss: {:.4f} Accuracy: {:.4f} Correct: {:d} Total: {:d}".format(
@@ -314,6 +555,75 @@ class QuasiSiameseNetwork(object):
 
         return epoch_loss, epoch_main_metric
 
+    def resume_checkpoint(self, run_report):
+        """
+        Restore the model, optimizer, learning rate scheduler, random number generators
+        and run report of the last completed epoch, see --resume
+
+        Returns:
+            checkpoint of the last completed epoch, None when there is nothing to resume
+        """
+        if not (self.resume and os.path.exists(self.resume_path)):
+            return None
+        checkpoint = torch.load(self.resume_path, map_location="cpu")
+        self.network.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+        set_rng_state(checkpoint["rng"])
+        for key, value in checkpoint["run_report"].items():
+            run_report[key] = value
+        logger.info(
+            "Resuming from epoch {:03d} of {}".format(
+                checkpoint["epoch"], self.resume_path
+            )
+        )
+        return checkpoint
+
+    def time_budget_stop_reason(self, epochs, budget_start_time):
+        """
+        Stop when another epoch of the average duration would exceed --max-train-minutes
+        Args:
+            epochs (int): number of epochs trained in this run
+            budget_start_time (float): time.time() at the start of the first epoch of this run
+
+        Returns:
+            "max_train_minutes" or None, the same in all processes
+        """
+        stop_reason = None
+        if self.max_train_seconds is not None:
+            seconds = time.time() - budget_start_time
+            if seconds + seconds / epochs > self.max_train_seconds:
+                stop_reason = "max_train_minutes"
+        # the processes measure different times, all follow the main process
+        return broadcast_value(stop_reason)
+
+    def validate(self, run_report, epoch, validation_loader, selection_metric):
+        """
+        Run the validation set, report its loss and score and step the learning rate
+        scheduler, whose patience therefore counts validations, see --validation-interval
+
+        Returns:
+            validation score
+        """
+        validation_loss, validation_score = self.run_epoch(
+            epoch,
+            validation_loader,
+            phase="validation",
+            selection_metric=selection_metric,
+        )
+        run_report.validation_epochs.append(epoch)
+        run_report.validation_loss.append(readable_float(validation_loss))
+        run_report.validation_score.append(readable_float(validation_score))
+        if self.stage_timer.enabled:
+            run_report.validation_stage_seconds.append(self.stage_seconds)
+
+        if is_main_process():
+            self.writer.add_scalar("Validation/Loss", validation_loss, epoch)
+            self.writer.add_scalar("Validation/Score", validation_score, epoch)
+
+        self.lr_scheduler.step(validation_loss)
+        return validation_score
+
     def train(self, run_report, datasets, number_of_epochs, selection_metric):
         """
         Train the model
@@ -325,13 +635,14 @@ class QuasiSiameseNetwork(object):
         Returns:
             run_report (dict): configuration parameters for training with training statistics
         """
-        train_set, train_loader = datasets.load("train")
-        validation_set, validation_loader = datasets.load("validation")
+        train_set, train_loader = self.load_dataset(datasets, "train")
+        validation_set, validation_loader = self.load_dataset(datasets, "validation")
 
-        best_validation_score, best_model_wts = (
-            0.0,
-            copy.deepcopy(self.model.state_dict()),
-        )
+        best_validation_score = 0.0
+        best_epoch = None
+        # validations since the best validation score, see --early-stopping-patience
+        validations_without_improvement = 0
+        first_epoch = 1
 
         start_time = time.time()
         run_report.train_start_time = (
@@ -339,45 +650,138 @@ class QuasiSiameseNetwork(object):
         )
         run_report.train_loss = []
         run_report.train_score = []
+        run_report.validation_epochs = []
         run_report.validation_loss = []
         run_report.validation_score = []
-
-        for epoch in range(1, number_of_epochs + 1):
+        # seconds per stage of every epoch, see --profile-stages
+        report_keys = (
+            "train_start_time",
+            "train_loss",
+            "train_score",
+            "validation_epochs",
+            "validation_loss",
+            "validation_score",
+        )
+        if self.stage_timer.enabled:
+            run_report.train_stage_seconds = []
+            run_report.validation_stage_seconds = []
+            report_keys += ("train_stage_seconds", "validation_stage_seconds")
+
+        checkpoint = self.resume_checkpoint(run_report)
+        if checkpoint is not None:
+            best_validation_score = checkpoint["best_validation_score"]
+            best_epoch = checkpoint.get("best_epoch")
+            validations_without_improvement = checkpoint.get(
+                "validations_without_improvement", 0
+            )
+            first_epoch = checkpoint["epoch"] + 1
+
+        # checkpoints are copied to the CPU and written while training continues
+        checkpoint_writer = CheckpointWriter() if is_main_process() else None
+        if is_main_process():
+            # imported here, tensorboard takes seconds to import and is only used for training
+            from torch.utils.tensorboard import SummaryWriter
+
+            # creates tracking file for tensorboard
+            self.writer = SummaryWriter(self.checkpoint_path)
+            self.stage_timer.writer = self.writer
+
+        stop_reason = None
+        # the time budget counts the epochs of this run, also when resuming
+        budget_start_time = time.time()
+        for epoch in range(first_epoch, number_of_epochs + 1):
             # train network
             train_loss, train_score = self.run_epoch(
                 epoch, train_loader, phase="train", selection_metric=selection_metric
             )
             run_report.train_loss.append(readable_float(train_loss))
             run_report.train_score.append(readable_float(train_score))
-
-            # eval on validation
-            validation_loss, validation_score = self.run_epoch(
-                epoch,
-                validation_loader,
-                phase="validation",
-                selection_metric=selection_metric,
-            )
-            run_report.validation_loss.append(readable_float(validation_loss))
-            run_report.validation_score.append(readable_float(validation_score))
+            if self.stage_timer.enabled:
+                run_report.train_stage_seconds.append(self.stage_seconds)
 
             # used for Tensorboard
-            self.writer.add_scalar("Train/Loss", train_loss, epoch)
-            self.writer.add_scalar("Train/Score", train_score, epoch)
-            self.writer.add_scalar("Validation/Loss", validation_loss, epoch)
-            self.writer.add_scalar("Validation/Score", validation_score, epoch)
+            if is_main_process():
+                self.writer.add_scalar("Train/Loss", train_loss, epoch)
+                self.writer.add_scalar("Train/Score", train_score, epoch)
+
+            stop_reason = None
+            if epoch < number_of_epochs:
+                stop_reason = self.time_budget_stop_reason(
+                    epoch - first_epoch + 1, budget_start_time
+                )
 
-            self.lr_scheduler.step(validation_loss)
+            # eval on validation, see --validation-interval
+            if (
+                epoch % self.validation_interval == 0
+                or epoch == number_of_epochs
+                or stop_reason is not None
+            ):
+                validation_score = self.validate(
+                    run_report, epoch, validation_loader, selection_metric
+                )
+
+                if validation_score > best_validation_score:
+                    best_validation_score = validation_score
+                    best_epoch = epoch
+                    validations_without_improvement = 0
 
-            if validation_score > best_validation_score:
-                best_validation_score = validation_score
-                best_model_wts = copy.deepcopy(self.model.state_dict())
+                    if is_main_process():
+                        logger.info(
+                            "Epoch {:03d} Checkpoint: Saving to {}".format(
+                                epoch, self.model_path
+                            )
+                        )
+                        checkpoint_writer.save(
+                            snapshot(self.network.state_dict()), self.model_path
+                        )
+                else:
+                    validations_without_improvement += 1
+
+            # validation scores are the same in all processes, so they stop together
+            if (
+                stop_reason is None
+                and self.early_stopping_patience is not None
+                and validations_without_improvement >= self.early_stopping_patience
+            ):
+                stop_reason = "early_stopping_patience"
+
+            # everything needed to continue training after this epoch, see --resume
+            if is_main_process():
+                checkpoint_writer.save(
+                    snapshot(
+                        {
+                            "epoch": epoch,
+                            "model": self.network.state_dict(),
+                            "optimizer": self.optimizer.state_dict(),
+                            "lr_scheduler": self.lr_scheduler.state_dict(),
+                            "rng": rng_state(),
+                            "best_validation_score": best_validation_score,
+                            "best_epoch": best_epoch,
+                            "validations_without_improvement": (
+                                validations_without_improvement
+                            ),
+                            "run_report": {key: run_report[key] for key in report_keys},
+                        }
+                    ),
+                    self.resume_path,
+                )
 
+            if stop_reason is not None:
                 logger.info(
-                    "Epoch {:03d} Checkpoint: Saving to {}".format(
-                        epoch, self.model_path
+                    "Epoch {:03d}: Stopping training, reached --{}".format(
+                        epoch, stop_reason.replace("_", "-")
                     )
                 )
-                torch.save(best_model_wts, self.model_path)
+                break
+
+        run_report.train_stop_reason = stop_reason or "number_of_epochs"
+        run_report.best_epoch = best_epoch
+
+        if is_main_process():
+            checkpoint_writer.close()
+
+        # the other processes test the checkpoint saved by the main process
+        barrier()
 
         time_elapsed = time.time() - start_time
         run_report.train_end_time = datetime.utcnow().replace(microsecond=0).isoformat()
@@ -402,12 +806,12 @@ class QuasiSiameseNetwork(object):
             run_report (dict): configuration parameters for testing with testing statistics
         """
         if self.is_statistical_model:
-            train_set, _ = datasets.load("train")
+            train_set, _ = datasets.load_labels("train")
         else:
-            self.model.load_state_dict(
+            self.network.load_state_dict(
                 torch.load(self.model_path, map_location=self.device)
             )
-        test_set, test_loader = datasets.load("test")
+        test_set, test_loader = self.load_dataset(datasets, "test")
         start_time = time.time()
         run_report[
             dynamic_report_key(
@@ -426,6 +830,12 @@ class QuasiSiameseNetwork(object):
         run_report[
             dynamic_report_key("test_score", self.model_type, self.is_statistical_model)
         ] = readable_float(test_score)
+        if self.stage_timer.enabled:
+            run_report[
+                dynamic_report_key(
+                    "test_stage_seconds", self.model_type, self.is_statistical_model
+                )
+            ] = self.stage_seconds
         time_elapsed = time.time() - start_time
         run_report[
             dynamic_report_key(
@@ -454,50 +864,124 @@ class QuasiSiameseNetwork(object):
         )
         return run_report
 
-    def inference(self, datasets):
+    def predictions(self, source, batch_size=32, number_of_workers=0):
+        """
+        Generator of the predictions of the model for image pairs
+        Args:
+            source: directory with before and after subdirectories,
+                text file with a "before_path after_path" pair per line, list of pairs,
+                or dataset of the inference set, see inference_source
+            batch_size (int): number of pairs per forward pass
+            number_of_workers (int): number of data loader workers decoding images
+
+        Yields:
+            (filename, prediction) for each pair, in order
+        """
+        if self.is_statistical_model:
+            return self.statistical_predictions(source, batch_size)
+
+        self.model = self.model.to(self.device)
+
+        self.model.eval()
+
+        def predict_batch(image1, image2):
+            _, preds = self.get_outputs_preds(
+                image1, image2, (image1.shape[0],), [image1.shape[0]]
+            )
+            return preds
+
+        return stream_predictions(
+            predict_batch,
+            source,
+            self.transforms["inference"],
+            self.device,
+            batch_size=batch_size,
+            number_of_workers=number_of_workers,
+        )
+
+    def statistical_predictions(self, source, batch_size):
+        """
+        Generator of the predictions of a statistical model, from the filenames
+        of the image pairs only, the images are never opened
+        """
+        if isinstance(source, Dataset):
+            filenames = [str(filename) for filename in source.filenames]
+        else:
+            filenames = [filename for filename, _, _ in inference_pairs(source)]
+        for start in range(0, len(filenames), batch_size):
+            batch_filenames = filenames[start : start + batch_size]
+            _, preds = self.get_outputs_preds(
+                None, None, (len(batch_filenames),), [len(batch_filenames)]
+            )
+            yield from zip(batch_filenames, preds.view(-1).tolist())
+
+    def inference_source(self, datasets, source=None):
+        """
+        Image pairs to run inference on, the inference set of the datasets by default
+        With --packed-data-path or --transform-cache-path the inference set is read
+        like the other splits, the cache is built on the first call. When started
+        with torchrun every process has to call this, the main process builds the cache.
+        Args:
+            datasets: DataSet object with datasets loaded
+            source: image pairs to predict, see predictions
+
+        Returns:
+            source, or the inference set as a directory or dataset
+        """
+        if source is not None:
+            return source
+        if self.is_statistical_model and datasets.packed_data_path is not None:
+            dataset, _ = datasets.load_labels("inference")
+            return dataset
+        if self.is_neural_model and (
+            datasets.packed_data_path is not None
+            or datasets.transform_cache_path is not None
+        ):
+            dataset, _ = datasets.load("inference")
+            return dataset
+        return os.path.join(datasets.data_path, "inference")
+
+    def inference(self, datasets, source=None):
         """
         Uses the model for inference
         Args:
             datasets: DataSet object with datasets loaded
+            source: image pairs to predict, see predictions, defaults to the inference set
         """
         if self.is_statistical_model:
-            train_set, _ = datasets.load("train")
+            train_set, _ = datasets.load_labels("train")
         else:
-            self.model.load_state_dict(
+            self.network.load_state_dict(
                 torch.load(self.model_path, map_location=self.device)
             )
-        inference_set, inference_loader = datasets.load("inference")
+        source = self.inference_source(datasets, source)
         start_time = time.time()
 
-        self.model = self.model.to(self.device)
-
-        self.model.eval()
-
-        prediction_file = self.create_prediction_file("inference", 1)
-        prediction_file.write("filename prediction\n")
+        # inference runs on the main process only
+        prediction_file = prediction_writer(
+            self.prediction_file_path("inference", 1),
+            ["filename", "prediction"],
+            self.prediction_format,
+        )
 
         if self.model_type == "average":
             self.average_label = self.calculate_average_label(train_set)
 
-        for idx, (filename, image1, image2) in enumerate(inference_loader, 1):
-            image1 = image1.to(self.device)
-            image2 = image2.to(self.device)
-
-            outputs, preds = self.get_outputs_preds(
-                image1, image2, image1.shape, [image1.shape[0]]
-            )
-
-            prediction_file.writelines(
-                [
-                    "{} {}\n".format(*line)
-                    for line in zip(filename, preds.view(-1).tolist())
-                ]
-            )
+        number_of_predictions = write_predictions(
+            prediction_file,
+            self.predictions(
+                source,
+                batch_size=datasets.batch_size,
+                number_of_workers=datasets.number_of_workers,
+            ),
+            batch_size=datasets.batch_size,
+        )
+        prediction_file.close()
 
         time_elapsed = time.time() - start_time
 
         logger.info(
-            "Inference complete in {:.0f}m {:.0f}s".format(
-                time_elapsed // 60, time_elapsed % 60
+            "Inference on {} buildings complete in {:.0f}m {:.0f}s".format(
+                number_of_predictions, time_elapsed // 60, time_elapsed % 60
             )
         )
@@ -0,0 +1,159 @@
+import os
+import sys
+import shutil
+import logging
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from model.data import CaladriusDataset, PACKED_INDEX_FILE, PACKED_SHARD_FILE
+
+logger = logging.getLogger(__name__)
+
+
+def read_file(file_path):
+    with open(file_path, "rb") as image_file:
+        return image_file.read()
+
+
+def pack_set(data_path, packed_data_path, set_name, shard_size):
+    """
+    Pack the before and after images of a dataset split into shard files
+    Args:
+        data_path (str): path of the Caladrius dataset
+        packed_data_path (str): path to write the packed dataset to
+        set_name (str): "train", "validation", "test" or "inference"
+        shard_size (int): size in bytes after which a new shard file is started
+
+    Returns:
+        number of packed datapoints
+    """
+    dataset = CaladriusDataset(data_path, set_name)
+
+    set_directory = os.path.join(packed_data_path, set_name)
+    # write next to the final directory so an interrupted run leaves no partial set
+    temporary_set_directory = set_directory + ".tmp"
+    if os.path.isdir(temporary_set_directory):
+        shutil.rmtree(temporary_set_directory)
+    os.makedirs(temporary_set_directory)
+
+    filenames = []
+    labels = np.full(len(dataset), np.nan, dtype=np.float64)
+    shards = np.zeros(len(dataset), dtype=np.int32)
+    before_offsets = np.zeros(len(dataset), dtype=np.int64)
+    before_lengths = np.zeros(len(dataset), dtype=np.int64)
+    after_offsets = np.zeros(len(dataset), dtype=np.int64)
+    after_lengths = np.zeros(len(dataset), dtype=np.int64)
+
+    shard_index = 0
+    shard_file = open(
+        os.path.join(temporary_set_directory, PACKED_SHARD_FILE.format(shard_index)),
+        "wb",
+    )
+    for idx, filename in enumerate(tqdm(dataset.filenames.tolist())):
+        labels[idx] = dataset.labels[idx]
+        before_image = read_file(os.path.join(dataset.directory, "before", filename))
+        after_image = read_file(os.path.join(dataset.directory, "after", filename))
+
+        if shard_file.tell() > 0 and (
+            shard_file.tell() + len(before_image) + len(after_image) > shard_size
+        ):
+            shard_file.close()
+            shard_index += 1
+            shard_file = open(
+                os.path.join(
+                    temporary_set_directory, PACKED_SHARD_FILE.format(shard_index)
+                ),
+                "wb",
+            )
+
+        filenames.append(filename)
+        shards[idx] = shard_index
+        before_offsets[idx] = shard_file.tell()
+        before_lengths[idx] = len(before_image)
+        shard_file.write(before_image)
+        after_offsets[idx] = shard_file.tell()
+        after_lengths[idx] = len(after_image)
+        shard_file.write(after_image)
+    shard_file.close()
+
+    np.savez(
+        os.path.join(temporary_set_directory, PACKED_INDEX_FILE),
+        filenames=np.array(filenames, dtype=str),
+        labels=labels,
+        shards=shards,
+        before_offsets=before_offsets,
+        before_lengths=before_lengths,
+        after_offsets=after_offsets,
+        after_lengths=after_lengths,
+        shard_count=np.array(shard_index + 1),
+    )
+
+    if os.path.isdir(set_directory):
+        shutil.rmtree(set_directory)
+    os.rename(temporary_set_directory, set_directory)
+
+    logger.info(
+        "Packed {} {} datapoints into {} shards".format(
+            len(filenames), set_name, shard_index + 1
+        )
+    )
+    return len(filenames)
+
+
+def main():
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.DEBUG,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+    logger.info("python {}".format(" ".join(sys.argv)))
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--data-path",
+        type=str,
+        default=os.path.join(".", "data", "Sint-Maarten-2017"),
+        help="data path",
+    )
+    parser.add_argument(
+        "--packed-data-path",
+        type=str,
+        required=True,
+        help="path to write the packed dataset to, "
+        "use it as --packed-data-path of run.py",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1024,
+        help="size of the shard files in megabytes",
+    )
+    parser.add_argument(
+        "--sets",
+        type=str,
+        nargs="+",
+        default=["train", "validation", "test", "inference"],
+        choices=["train", "validation", "test", "inference"],
+        help="dataset splits to pack, splits missing from --data-path are skipped",
+    )
+
+    args = parser.parse_args()
+
+    for set_name in args.sets:
+        if not os.path.isdir(os.path.join(args.data_path, set_name)):
+            logger.info("Skipping {}, not found in {}".format(set_name, args.data_path))
+            continue
+        pack_set(
+            args.data_path, args.packed_data_path, set_name, args.shard_size * 1024**2
+        )
+
+    logger.info("Packed dataset written to {}".format(args.packed_data_path))
+
+
+if __name__ == "__main__":
+    main()
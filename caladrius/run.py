@@ -1,20 +1,27 @@
 import os
 import sys
 
-from model.data import Datasets
 from utils import (
     configuration,
+    configure_logging,
     create_logger,
     attach_exception_hook,
+    init_distributed,
+    is_main_process,
     load_run_report,
     save_run_report,
     dotdict,
 )
-from model.trainer import QuasiSiameseNetwork
 
 
 def main():
     args = configuration()
+    # imported after parsing the arguments, so --help does not wait for torch and torchvision
+    from model.data import Datasets
+    from model.trainer import QuasiSiameseNetwork
+
+    init_distributed(args)
+    configure_logging(args)
     run_report = load_run_report(args.run_report_path)
 
     logger = create_logger(__name__)
@@ -34,13 +41,18 @@ def main():
         run_report = qsn.train(
             run_report, datasets, args.number_of_epochs, args.selection_metric
         )
-    logger.info("Evaluating on test dataset")
-    run_report = qsn.test(run_report, datasets)
+    if args.test or not args.inference:
+        logger.info("Evaluating on test dataset")
+        run_report = qsn.test(run_report, datasets)
     if args.inference:
-        logger.info("Inference started")
-        qsn.inference(datasets)
-
-    save_run_report(run_report)
+        # all processes wait while the main process packs or caches the inference set
+        source = qsn.inference_source(datasets, args.inference_input)
+        if is_main_process():
+            logger.info("Inference started")
+            qsn.inference(datasets, source)
+
+    if is_main_process():
+        save_run_report(run_report)
     logger.info("END")
 
 
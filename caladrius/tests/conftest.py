@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of caladrius import each other relative to the caladrius directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from model.evaluate import RollingEval  # noqa: E402
+
+# class 3 never occurs, so it is not scored
+LABELS = np.array([0, 0, 0, 1, 1, 2, 2, 2, 2, 1])
+PREDICTIONS = np.array([0, 1, 0, 1, 2, 2, 2, 0, 1, 1])
+
+
+def direct_scores(labels, predictions):
+    """
+    Precision, recall and f1 of every present class, and the label counts
+    """
+    classes = np.union1d(labels, predictions)
+    precision, recall, f1, support = [], [], [], []
+    for label in classes:
+        true_positives = np.sum((labels == label) & (predictions == label))
+        predicted = np.sum(predictions == label)
+        actual = np.sum(labels == label)
+        precision.append(true_positives / predicted if predicted else 0.0)
+        recall.append(true_positives / actual if actual else 0.0)
+        f1.append(2 * true_positives / (predicted + actual))
+        support.append(actual)
+    return (np.array(values) for values in (precision, recall, f1, support))
+
+
+def test_scores_match_a_direct_computation():
+    rolling_eval = RollingEval("classification", n_classes=4)
+    # the epoch is added in two batches
+    for batch in (slice(0, 6), slice(6, 10)):
+        rolling_eval.add(
+            torch.from_numpy(LABELS[batch]), torch.from_numpy(PREDICTIONS[batch]), 0.5
+        )
+    accuracy, correct, total, micro, macro, weighted = rolling_eval.score()
+
+    precision, recall, f1, support = direct_scores(LABELS, PREDICTIONS)
+    assert correct == 6
+    assert total == 10
+    assert accuracy == pytest.approx(0.6)
+    # every datapoint has one label and one prediction, so all micro averages are accuracy
+    assert micro[:3] == pytest.approx((0.6, 0.6, 0.6))
+    assert macro[:3] == pytest.approx((precision.mean(), recall.mean(), f1.mean()))
+    weights = support / support.sum()
+    assert weighted[:3] == pytest.approx(
+        ((precision * weights).sum(), (recall * weights).sum(), (f1 * weights).sum())
+    )
+    assert rolling_eval.loss() == pytest.approx(0.5)
+
+
+def test_batch_score_covers_the_last_batch():
+    rolling_eval = RollingEval("classification", n_classes=4)
+    rolling_eval.add(torch.tensor([0, 1]), torch.tensor([0, 1]), 1.0)
+    rolling_eval.add(torch.tensor([2, 2]), torch.tensor([0, 2]), 1.0)
+    accuracy, correct, total = rolling_eval.batch_score()[:3]
+    assert (accuracy, correct, total) == (0.5, 1, 2)
+    assert rolling_eval.score()[:3] == (0.75, 3, 4)
+
+
+def test_regression_outputs_are_scored_as_damage_classes():
+    rolling_eval = RollingEval("regression")
+    labels = torch.tensor([0.1, 0.5, 0.9, 0.8])
+    outputs = torch.tensor([0.2, 0.2, 0.75, 0.4])
+    rolling_eval.add(labels, outputs, 0.25)
+    assert rolling_eval.confusion_matrix.tolist() == [
+        [1, 0, 0],
+        [1, 0, 0],
+        [0, 1, 1],
+    ]
+    assert rolling_eval.score()[:3] == (0.5, 2, 4)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from model import predictions as predictions_module
+from model.predictions import load_predictions, prediction_writer, write_predictions
+
+
+def test_npy_columns_are_float32(tmp_path):
+    torch = pytest.importorskip("torch")
+    # evaluated splits write tensors, inference writes Python floats
+    evaluated = prediction_writer(
+        str(tmp_path / "test"), ["filename", "label", "prediction"], "npy"
+    )
+    evaluated.write(["a", "b"], torch.tensor([0.0, 1.0]), torch.tensor([0.25, 0.5]))
+    evaluated.close()
+    inference = prediction_writer(
+        str(tmp_path / "inference"), ["filename", "prediction"], "npy"
+    )
+    write_predictions(inference, [("a", 0.25), ("b", 0.5)])
+    inference.close()
+
+    for name, columns in (
+        ("test", ["label", "prediction"]),
+        ("inference", ["prediction"]),
+    ):
+        predictions = load_predictions(str(tmp_path / name))
+        assert predictions["filename"].tolist() == ["a", "b"]
+        for column in columns:
+            assert predictions[column].dtype == np.float32
+    assert load_predictions(str(tmp_path / "inference"))["prediction"].tolist() == [
+        0.25,
+        0.5,
+    ]
+
+
+def test_predictions_do_not_import_torch():
+    import subprocess
+
+    code = "import sys, model.predictions; print('torch' in sys.modules)"
+    caladrius_path = os.path.dirname(os.path.dirname(predictions_module.__file__))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=caladrius_path)
+    assert output.strip() == b"False"
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from model.data import AliasSampler, StratifiedBatchSampler, label_classes  # noqa: E402
+
+# 80, 15 and 5 datapoints of the three damage classes, interleaved
+CLASSES = np.random.RandomState(0).permutation([0] * 80 + [1] * 15 + [2] * 5)
+
+
+def test_alias_table_matches_weights():
+    weights = np.array([1.0, 3.0, 0.5, 2.5, 3.0])
+    probabilities, aliases = AliasSampler.alias_table(weights)
+    # an index is drawn uniformly, then kept or replaced by its alias
+    drawn = probabilities.copy()
+    np.add.at(drawn, aliases, 1.0 - probabilities)
+    assert np.allclose(drawn / len(weights), weights / weights.sum())
+
+
+def test_alias_sampler_balances_classes():
+    sampler = AliasSampler(CLASSES, seed=1)
+    samples = []
+    for epoch in range(100):
+        sampler.set_epoch(epoch)
+        samples.extend(sampler)
+    assert len(samples) == 100 * len(CLASSES)
+    frequencies = np.bincount(CLASSES[samples]) / len(samples)
+    assert np.allclose(frequencies, 1 / 3, atol=0.02)
+
+
+def test_alias_sampler_is_seeded():
+    first, second = AliasSampler(CLASSES, seed=1), AliasSampler(CLASSES, seed=1)
+    assert list(first) == list(second)
+    second.set_epoch(1)
+    assert list(first) != list(second)
+
+
+@pytest.mark.parametrize("batch_size", [6, 7, 32])
+def test_stratified_batches_hold_every_class(batch_size):
+    sampler = StratifiedBatchSampler(CLASSES, batch_size, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == len(CLASSES) // batch_size
+    for batch in batches:
+        assert len(batch) == batch_size
+        counts = np.bincount(CLASSES[batch], minlength=3)
+        assert counts.min() >= batch_size // 3
+        assert counts.max() <= -(-batch_size // 3)
+
+
+def test_stratified_batches_visit_the_majority_class_without_repeats():
+    sampler = StratifiedBatchSampler(CLASSES, 6, seed=1)
+    indices = [index for batch in sampler for index in batch]
+    majority = [index for index in indices if CLASSES[index] == 0]
+    assert len(majority) == len(set(majority))
+
+
+def test_label_classes_bins_regression_labels():
+    labels = [0.0, 0.3, 0.31, 0.69, 0.7, 1.0]
+    assert label_classes(labels, "regression").tolist() == [0, 0, 1, 1, 2, 2]
+    assert label_classes([3.0, 1.0], "classification").tolist() == [3, 1]
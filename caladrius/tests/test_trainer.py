@@ -0,0 +1,195 @@
+import os
+import sys
+
+import numpy as np
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+from utils import configuration, dotdict  # noqa: E402
+from model import trainer  # noqa: E402
+from model.data import Datasets  # noqa: E402
+
+
+def write_labels(data_path, set_name, labels):
+    """
+    labels.txt of a split, without any image
+    """
+    set_path = data_path / set_name
+    set_path.mkdir(parents=True)
+    with open(str(set_path / "labels.txt"), "w") as labels_file:
+        for index, label in enumerate(labels):
+            labels_file.write("{}.png {}\n".format(index, label))
+
+
+def parse_args(monkeypatch, tmp_path, *arguments):
+    """
+    Arguments of run.py, with the run directories in tmp_path
+    """
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "run.py",
+            "--checkpoint-path",
+            str(tmp_path / "runs"),
+            "--run-name",
+            "test_run",
+            "--disable-cuda",
+        ]
+        + list(arguments),
+    )
+    configuration.cache_clear()
+    return configuration()
+
+
+@pytest.fixture(autouse=True)
+def clear_configuration():
+    yield
+    configuration.cache_clear()
+
+
+@pytest.fixture
+def statistical_args(tmp_path, monkeypatch, request):
+    data_path = tmp_path / "data"
+    write_labels(data_path, "train", [0.0, 0.5, 1.0, 0.5])
+    write_labels(data_path, "test", [0.25, 0.75, 1.0])
+    return parse_args(
+        monkeypatch,
+        tmp_path,
+        "--model-type",
+        request.param,
+        "--data-path",
+        str(data_path),
+        "--batch-size",
+        "2",
+    )
+
+
+def fail(*args, **kwargs):
+    raise AssertionError("statistical models do not build a network")
+
+
+@pytest.mark.parametrize("statistical_args", ["average", "random"], indirect=True)
+def test_statistical_model_builds_no_network(statistical_args, monkeypatch):
+    for name in (
+        "InceptionSiameseNetwork",
+        "LightSiameseNetwork",
+        "Adam",
+        "ReduceLROnPlateau",
+        "get_pretrained_iv3_transforms",
+        "get_light_siamese_transforms",
+    ):
+        monkeypatch.setattr(trainer, name, fail)
+
+    qsn = trainer.QuasiSiameseNetwork(statistical_args)
+    assert qsn.model is None
+    assert qsn.optimizer is None
+    assert qsn.transforms == {}
+
+    run_report = qsn.test(dotdict({}), Datasets(statistical_args, qsn.transforms))
+    key = "{}_model_test_score".format(statistical_args.model_type)
+    assert key in run_report
+
+
+@pytest.mark.parametrize(
+    "model_type, output_type, input_size",
+    [
+        ("inception", "regression", 299),
+        ("light", "regression", 64),
+        ("probability", "classification", 299),
+    ],
+)
+@pytest.mark.parametrize(
+    "mode",
+    [["--channels-last"], ["--precision", "bf16"]],
+    ids=["channels_last", "bf16"],
+)
+def test_forward(tmp_path, monkeypatch, model_type, output_type, input_size, mode):
+    import torchvision
+
+    inception_v3 = torchvision.models.inception_v3
+    # random weights, the pretrained weights are a download
+    monkeypatch.setattr(
+        torchvision.models,
+        "inception_v3",
+        lambda pretrained=False: inception_v3(weights=None, init_weights=False),
+    )
+    # a forward pass does not use the learning rate scheduler
+    monkeypatch.setattr(trainer, "ReduceLROnPlateau", lambda optimizer, **kwargs: None)
+    args = parse_args(
+        monkeypatch,
+        tmp_path,
+        "--model-type",
+        model_type,
+        "--output-type",
+        output_type,
+        *mode
+    )
+    qsn = trainer.QuasiSiameseNetwork(args)
+    qsn.network.eval()
+
+    image1, image2 = torch.rand(2, 2, 3, input_size, input_size)
+    with torch.no_grad():
+        outputs, preds = qsn.get_outputs_preds(image1, image2, (2,), [2])
+    assert outputs.dtype == torch.float32
+    assert torch.isfinite(outputs).all()
+    assert preds.shape[0] == 2
+
+
+def write_image_pairs(set_path, number_of_pairs, size):
+    from PIL import Image
+
+    random = np.random.RandomState(0)
+    for directory in ("before", "after"):
+        (set_path / directory).mkdir(parents=True)
+        for index in range(number_of_pairs):
+            pixels = random.randint(0, 256, (size, size, 3), np.uint8)
+            Image.fromarray(pixels).save(
+                str(set_path / directory / "{}.png".format(index))
+            )
+
+
+@pytest.mark.parametrize("option", ["--transform-cache-path", "--packed-data-path"])
+def test_inference_reads_packed_and_cached_sets(tmp_path, monkeypatch, option):
+    from pack_dataset import pack_set
+    from model.predictions import load_predictions
+
+    data_path = tmp_path / "data"
+    write_image_pairs(data_path / "inference", 5, 72)
+    option_path = tmp_path / "option"
+    if option == "--packed-data-path":
+        pack_set(str(data_path), str(option_path), "inference", 2 ** 20)
+    # a forward pass does not use the learning rate scheduler
+    monkeypatch.setattr(trainer, "ReduceLROnPlateau", lambda optimizer, **kwargs: None)
+
+    predictions = []
+    for arguments in ([], [option, str(option_path)]):
+        args = parse_args(
+            monkeypatch,
+            tmp_path,
+            "--model-type",
+            "light",
+            "--data-path",
+            str(data_path),
+            "--batch-size",
+            "2",
+            "--number-of-workers",
+            "0",
+            "--prediction-format",
+            "npy",
+            *arguments
+        )
+        qsn = trainer.QuasiSiameseNetwork(args)
+        if not arguments:
+            torch.save(qsn.network.state_dict(), args.model_path)
+        datasets = Datasets(args, qsn.transforms)
+        source = qsn.inference_source(datasets)
+        qsn.inference(datasets, source)
+        predictions.append(load_predictions(qsn.prediction_file_path("inference", 1)))
+
+    assert isinstance(source, torch.utils.data.Dataset)
+    assert os.listdir(str(option_path))
+    assert predictions[1]["filename"].tolist() == predictions[0]["filename"].tolist()
+    assert np.allclose(predictions[1]["prediction"], predictions[0]["prediction"])
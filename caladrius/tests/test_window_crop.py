@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+import rasterio.mask  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+
+from dataset.window_crop import BlockCache, crop_geometry  # noqa: E402
+
+# 64 x 64 pixels in 16 x 16 blocks, one unit per pixel, origin at (0, 64)
+SIZE = 64
+BLOCK_SIZE = 16
+
+
+def polygon(left, bottom, right, top):
+    return {
+        "type": "Polygon",
+        "coordinates": [
+            [(left, bottom), (right, bottom), (right, top), (left, top), (left, bottom)]
+        ],
+    }
+
+
+GEOMETRIES = {
+    "inside_one_block": [polygon(2.5, 50.5, 12.5, 60.5)],
+    "across_blocks": [polygon(10.3, 10.7, 40.6, 37.2)],
+    "partly_outside": [polygon(50.5, -10.0, 80.0, 20.5)],
+}
+
+
+@pytest.fixture(params=[None, 7], ids=["no_nodata", "nodata"])
+def geotiff(tmp_path, request):
+    """
+    Small tiled GeoTIFF with random pixels
+    """
+    path = str(tmp_path / "image.tif")
+    pixels = np.random.RandomState(0).randint(1, 256, (3, SIZE, SIZE)).astype(np.uint8)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=SIZE,
+        height=SIZE,
+        count=3,
+        dtype="uint8",
+        crs="EPSG:32620",
+        transform=from_origin(0, SIZE, 1, 1),
+        tiled=True,
+        blockxsize=BLOCK_SIZE,
+        blockysize=BLOCK_SIZE,
+        nodata=request.param,
+    ) as dataset:
+        dataset.write(pixels)
+    with rasterio.open(path) as dataset:
+        yield dataset
+
+
+@pytest.mark.parametrize("name", sorted(GEOMETRIES))
+@pytest.mark.parametrize("block_cache_size", [0, 1024 ** 2], ids=["direct", "cached"])
+def test_crop_geometry_matches_rasterio_mask(geotiff, name, block_cache_size):
+    geometry = GEOMETRIES[name]
+    expected_image, expected_transform = rasterio.mask.mask(
+        geotiff, geometry, crop=True
+    )
+    block_cache = BlockCache(block_cache_size) if block_cache_size else None
+
+    image, transform = crop_geometry(geotiff, geometry, block_cache=block_cache)
+
+    assert image.dtype == expected_image.dtype
+    assert image.shape == expected_image.shape
+    assert image.tobytes() == expected_image.tobytes()
+    assert transform == expected_transform
+
+
+def test_block_cache_reuses_blocks(geotiff):
+    block_cache = BlockCache(1024 ** 2)
+    crop_geometry(geotiff, GEOMETRIES["across_blocks"], block_cache=block_cache)
+    blocks = list(block_cache.blocks)
+
+    crop_geometry(geotiff, GEOMETRIES["across_blocks"], block_cache=block_cache)
+
+    assert len(blocks) > 1
+    assert list(block_cache.blocks) == blocks
@@ -6,8 +6,7 @@ import pickle
 import logging
 import re
 import json
-
-import torch
+import functools
 
 NEURAL_MODELS = ["inception", "light", "probability"]
 STATISTICAL_MODELS = ["average", "random"]
@@ -19,6 +18,11 @@ logging.getLogger("fiona.collection").setLevel(logging.ERROR)
 logging.getLogger("rasterio").setLevel(logging.ERROR)
 logging.getLogger("PIL.PngImagePlugin").setLevel(logging.ERROR)
 
+# loggers of create_logger and the handlers and level configure_logging sets on them
+LOGGERS = []
+LOGGING_HANDLERS = []
+LOGGING_LEVEL = [logging.NOTSET]
+
 
 class dotdict(dict):
     """
@@ -77,7 +81,25 @@ def run_name_type(run_name):
     return run_name
 
 
+def positive_int_type(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def default_run_name():
+    # processes started by torchrun share the run id, so they write to the same run
+    if "TORCHELASTIC_RUN_ID" in os.environ:
+        return re.sub(r"[^a-zA-Z0-9]", "", os.environ["TORCHELASTIC_RUN_ID"])[:30]
+    return "{:.0f}".format(time.time())
+
+
+@functools.lru_cache(maxsize=None)
 def configuration():
+    """
+    Parse the command line, once per process, later calls return the same arguments
+    """
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
@@ -95,11 +117,39 @@ def configuration():
         default=os.path.join(".", "data", "Sint-Maarten-2017"),
         help="data path",
     )
+    parser.add_argument(
+        "--packed-data-path",
+        type=str,
+        default=None,
+        help="read the datasets packed by pack_dataset.py from this path "
+        "instead of the image files in --data-path",
+    )
+    parser.add_argument(
+        "--transform-cache-path",
+        type=str,
+        default=None,
+        help="cache the validation, test and inference sets after resizing and cropping "
+        "as memory mapped arrays in this path, so later epochs skip image decoding",
+    )
+    parser.add_argument(
+        "--frozen-feature-cache",
+        type=str,
+        default="off",
+        choices=["off", "evaluation", "all"],
+        help="cache the output of the frozen inception layers for the validation and test "
+        "sets (evaluation), or for all sets (all, trains without augmentation)",
+    )
+    parser.add_argument(
+        "--frozen-feature-cache-path",
+        type=str,
+        default=os.path.join(".", "cache"),
+        help="path of the frozen feature cache",
+    )
     parser.add_argument(
         "--run-name",
         type=run_name_type,
-        default="{:.0f}".format(time.time()),
-        help="name to identify execution",
+        default=default_run_name(),
+        help="name to identify execution (default: <timestamp>, or the run id of torchrun)",
     )
     parser.add_argument(
         "--log-step",
@@ -124,6 +174,14 @@ def configuration():
     parser.add_argument(
         "--disable-cuda", action="store_true", help="disable the use of CUDA"
     )
+    parser.add_argument(
+        "--distributed-backend",
+        type=str,
+        default="gloo",
+        choices=["gloo", "nccl"],
+        help="backend of the process group when started with torchrun, "
+        "nccl needs a GPU for every process, gloo also works on CPU-only nodes",
+    )
     parser.add_argument(
         "--cuda-device", type=int, default=0, help="specify which GPU to use"
     )
@@ -141,6 +199,25 @@ def configuration():
         default=100,
         help="number of epochs for training",
     )
+    parser.add_argument(
+        "--early-stopping-patience",
+        type=int,
+        default=None,
+        help="stop training after this many validations without a better validation score",
+    )
+    parser.add_argument(
+        "--max-train-minutes",
+        type=float,
+        default=None,
+        help="stop training before an epoch would end after this many minutes of training",
+    )
+    parser.add_argument(
+        "--validation-interval",
+        type=positive_int_type,
+        default=1,
+        help="validate every this many epochs, and after the last epoch, "
+        "the patience of the learning rate scheduler counts validations",
+    )
     parser.add_argument(
         "--batch-size", type=int, default=32, help="batch size for training"
     )
@@ -148,6 +225,70 @@ def configuration():
         "--learning-rate", type=float, default=0.001, help="learning rate for training"
     )
 
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="shuffle",
+        choices=["shuffle", "weighted", "stratified"],
+        help="order of the training datapoints: shuffled, drawn with the same probability "
+        "for every damage class, or batches with the same number of datapoints of every class",
+    )
+    parser.add_argument(
+        "--batch-augmentation",
+        action="store_true",
+        default=False,
+        help="randomly crop, flip and rotate the training images in batches on the device, "
+        "instead of one by one in the data loader workers",
+    )
+    parser.add_argument(
+        "--paired-augmentation",
+        action="store_true",
+        default=False,
+        help="crop, flip and rotate the before and after image of a pair the same way, "
+        "so they stay aligned",
+    )
+    parser.add_argument(
+        "--shared-backbone",
+        action="store_true",
+        default=False,
+        help="use one backbone network, with the same weights, for the before and after images",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="run the forward and backward passes of the model in this precision, "
+        "bf16 uses autocast and needs hardware support for bfloat16",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        default=False,
+        help="use the channels last memory format for images and convolution weights",
+    )
+
+    parser.add_argument(
+        "--profile-stages",
+        action="store_true",
+        default=False,
+        help="time data loading, copies, forward, loss, backward, optimizer, metrics and "
+        "prediction writes of every batch, for tensorboard and the run report, "
+        "synchronizes the device after every stage",
+    )
+    parser.add_argument(
+        "--profile-trace-batches",
+        type=int,
+        default=0,
+        help="record a torch.profiler trace of this many batches of the first training epoch, "
+        "in the profiler directory of the run, after a skipped and a warm up batch",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="continue training a run with the same --run-name from its last completed epoch",
+    )
     parser.add_argument(
         "--test",
         action="store_true",
@@ -158,7 +299,23 @@ def configuration():
         "--inference",
         action="store_true",
         default=False,
-        help="test and use the model on the inference set instead of training",
+        help="use the model on the inference set instead of training, "
+        "combine with --test to also test the model",
+    )
+    parser.add_argument(
+        "--prediction-format",
+        type=str,
+        default="text",
+        choices=["text", "npy"],
+        help="write predictions as text files, or as directories with a .npy file per column",
+    )
+    parser.add_argument(
+        "--inference-input",
+        type=str,
+        default=None,
+        help="directory with before and after image directories, or text file with "
+        "a 'before_path after_path' pair per line, to use for inference "
+        "(default: the inference set in --data-path)",
     )
     parser.add_argument(
         "--max-data-points",
@@ -190,6 +347,8 @@ def configuration():
     )
 
     args = parser.parse_args()
+    # imported after parsing, so --help does not wait for torch
+    import torch
 
     arg_vars = vars(args)
     arg_vars["model_name"] = arg_vars["run_name"]
@@ -222,12 +381,23 @@ def configuration():
     arg_vars["model_path"] = os.path.join(
         arg_vars["checkpoint_path"], "best_model_wts.pkl"
     )
+    arg_vars["resume_path"] = os.path.join(
+        arg_vars["checkpoint_path"], "last_checkpoint.pkl"
+    )
     arg_vars["run_report_path"] = os.path.join(
         arg_vars["checkpoint_path"], "run_report.json"
     )
     arg_vars["statistical_model"] = arg_vars["model_type"] in STATISTICAL_MODELS
     arg_vars["neural_model"] = arg_vars["model_type"] in NEURAL_MODELS
 
+    # set by torchrun, each process trains on its own share of the data
+    arg_vars["world_size"] = int(os.environ.get("WORLD_SIZE", 1))
+    arg_vars["rank"] = int(os.environ.get("RANK", 0))
+    arg_vars["local_rank"] = int(os.environ.get("LOCAL_RANK", 0))
+    arg_vars["distributed"] = arg_vars["world_size"] > 1
+    if arg_vars["distributed"]:
+        arg_vars["cuda_device"] = arg_vars["local_rank"]
+
     if torch.cuda.is_available() and not arg_vars["disable_cuda"]:
         arg_vars["device"] = torch.device("cuda:{}".format(arg_vars["cuda_device"]))
     else:
@@ -236,7 +406,91 @@ def configuration():
     return args
 
 
+def init_distributed(args):
+    import torch
+    import torch.distributed as dist
+
+    if not args.distributed or dist.is_initialized():
+        return
+    if args.distributed_backend == "nccl" and args.device.type != "cuda":
+        raise ValueError("the nccl backend needs a GPU for every process")
+    if args.device.type == "cuda":
+        # collectives of nccl, including the object collectives, run on the current device
+        torch.cuda.set_device(args.device)
+    dist.init_process_group(backend=args.distributed_backend)
+
+
+def collective_device():
+    """
+    Device of the tensors passed to collectives, nccl only reduces CUDA tensors
+    """
+    import torch
+    import torch.distributed as dist
+
+    if dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def is_main_process():
+    import torch.distributed as dist
+
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    import torch.distributed as dist
+
+    if dist.is_initialized():
+        dist.barrier()
+
+
+class main_process_first(object):
+    """
+    Context in which the main process runs first and the others wait for it,
+    e.g. to let only the main process build a cache the others then read
+    """
+
+    def __enter__(self):
+        if not is_main_process():
+            barrier()
+
+    def __exit__(self, *exception):
+        if is_main_process():
+            barrier()
+
+
+def broadcast_value(value):
+    """
+    Value of the main process on all processes, when started with torchrun
+    """
+    import torch.distributed as dist
+
+    if not dist.is_initialized():
+        return value
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+    return values[0]
+
+
+def gather_list(values):
+    """
+    Concatenation of the lists of all processes on the main process, when started with torchrun
+    """
+    import torch.distributed as dist
+
+    if not dist.is_initialized():
+        return values
+    gathered = [None] * dist.get_world_size() if is_main_process() else None
+    dist.gather_object(values, gathered, dst=0)
+    if is_main_process():
+        return [value for process_values in gathered for value in process_values]
+    return []
+
+
 def load_run_report(run_report_path):
+    import torch
+
     run_report_json = dotdict({})
     if os.path.exists(run_report_path):
         with open(run_report_path, "r") as run_report_file:
@@ -263,7 +517,26 @@ def attach_exception_hook(logger):
 
 
 def create_logger(module_name):
-    args = configuration()
+    """
+    Logger of a module, it only gets its handlers once configure_logging is called,
+    so modules can be imported without parsing the command line or creating files
+    """
+    logger = logging.getLogger(module_name)
+    if logger not in LOGGERS:
+        LOGGERS.append(logger)
+        for handler in LOGGING_HANDLERS:
+            logger.addHandler(handler)
+        logger.setLevel(LOGGING_LEVEL[0])
+    return logger
+
+
+def configure_logging(args):
+    """
+    Log to stdout and to run_debug.log and run_info.log in the checkpoint path,
+    from all loggers of create_logger, including the ones created later
+    """
+    if LOGGING_HANDLERS:
+        return
 
     debug_filehandler = logging.FileHandler(
         os.path.join(args.checkpoint_path, "run_debug.log")
@@ -283,12 +556,11 @@ def create_logger(module_name):
     streamhandler.setFormatter(formatter)
     streamhandler.setLevel(logging.DEBUG)
 
-    logger = logging.getLogger(module_name)
+    LOGGING_HANDLERS.extend([debug_filehandler, info_filehandler, streamhandler])
+    # only the main process logs progress when started with torchrun
+    LOGGING_LEVEL[0] = logging.DEBUG if args.rank == 0 else logging.WARNING
 
-    logger.addHandler(debug_filehandler)
-    logger.addHandler(info_filehandler)
-    logger.addHandler(streamhandler)
-
-    logger.setLevel(logging.DEBUG)
-
-    return logger
+    for logger in LOGGERS:
+        for handler in LOGGING_HANDLERS:
+            logger.addHandler(handler)
+        logger.setLevel(LOGGING_LEVEL[0])